@@ -1,19 +1,27 @@
 
-from flask import Flask, render_template, request, redirect, url_for, send_file, flash, session
-import sqlite3, os
-from contextlib import closing
-from datetime import date, datetime
-from reportlab.pdfgen import canvas
-from reportlab.lib.units import inch
-from reportlab.lib.pagesizes import letter
-from reportlab.lib import colors
-from reportlab.lib.utils import ImageReader
+from flask import Flask, render_template, request, redirect, url_for, send_file, flash, session, g, has_app_context, jsonify, Response
+import sqlite3, os, pathlib, multiprocessing, re, glob, hashlib, threading, uuid, itertools, io, csv, json, time, zipfile, bisect, logging, random, math, gzip, shutil
+import click
+from contextlib import closing, contextmanager, nullcontext
+from xml.sax.saxutils import escape
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from werkzeug.utils import secure_filename
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
 APP_TITLE = "DD Brothers — Transport Manager"
 BASE_DIR = os.path.dirname(__file__)
-DB_PATH = os.path.join(BASE_DIR, "dd_manager.db")
+# DD_DB_PATH / DD_REPORTS_DIR point a run (benchmarks, `flask seed`) at scratch files instead.
+DB_PATH = os.environ.get("DD_DB_PATH") or os.path.join(BASE_DIR, "dd_manager.db")
 LOGO_PATH = os.path.join("static", "dd_logo.png")
-REPORTS_DIR = os.path.join(BASE_DIR, "reports")
+REPORTS_DIR = os.environ.get("DD_REPORTS_DIR") or os.path.join(BASE_DIR, "reports")
+ARCHIVE_DIR = os.environ.get("DD_ARCHIVE_DIR") or os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "archive")
+BACKUP_DIR = os.environ.get("DD_BACKUP_DIR") or os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "backups")
 
 COMPANY_NAME = "DD BROTHERS TRANSPORT INC."
 COMPANY_ADDR = "100 Larry Cres, Caledonia ON. N3W 0C9"
@@ -25,14 +33,198 @@ ADMIN_USERNAME = "DD brothers"
 ADMIN_PASSWORD = "Ash#1Laddi"
 DELETE_PASSWORD = "1322420"
 
-def get_db():
-    conn = sqlite3.connect(DB_PATH)
+# ---------- Instrumentation ----------
+# Prometheus histograms for requests, SQL statements and PDF renders, served on /metrics. They live in
+# process memory, so under gunicorn each worker reports its own (and year-pack worker processes none).
+# DD_SLOW_QUERY_MS sets the slow-query log threshold, DD_SERVER_TIMING=1 adds a Server-Timing header to
+# every response. /metrics needs a login session, or, when DD_METRICS_TOKEN is set, that bearer token.
+SLOW_QUERY_MS = float(os.environ.get("DD_SLOW_QUERY_MS", "250"))
+SERVER_TIMING = os.environ.get("DD_SERVER_TIMING", "0") not in ("", "0")
+METRICS_TOKEN = os.environ.get("DD_METRICS_TOKEN")
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+PAGE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500)
+BYTE_BUCKETS = (10**4, 5*10**4, 10**5, 5*10**5, 10**6, 5*10**6, 10**7, 5*10**7)
+METRICS = []
+slow_log = logging.getLogger("dd.slow_query")
+
+class Histogram:
+    def __init__(self, name, help, buckets, labels):
+        self.name, self.help, self.buckets, self.labels = name, help, buckets, labels
+        self.series = {}; self.lock = threading.Lock()
+        METRICS.append(self)
+
+    def observe(self, value, *labels):
+        with self.lock:
+            s = self.series.get(labels)
+            if s is None:
+                s = self.series[labels] = [[0]*(len(self.buckets)+1), 0.0]
+            s[0][bisect.bisect_left(self.buckets, value)] += 1
+            s[1] += value
+
+    def render(self):
+        with self.lock:
+            series = sorted((k, list(v[0]), v[1]) for k, v in self.series.items())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, counts, total in series:
+            tags = ",".join(f'{k}="{prom_escape(v)}"' for k, v in zip(self.labels, labels))
+            running = 0
+            for le, n in zip((*self.buckets, "+Inf"), counts):
+                running += n
+                lines.append(f'{self.name}_bucket{{{tags},le="{le}"}} {running}')
+            lines.append(f"{self.name}_sum{{{tags}}} {total}")
+            lines.append(f"{self.name}_count{{{tags}}} {running}")
+        return lines
+
+def prom_escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+REQUEST_SECONDS = Histogram("dd_request_duration_seconds", "Request handling time (to the first byte for streamed responses).", TIME_BUCKETS, ("method", "endpoint", "status"))
+QUERY_SECONDS = Histogram("dd_sql_query_duration_seconds", "Time spent executing a statement and fetching its rows.", TIME_BUCKETS, ("statement",))
+QUERY_ROWS = Histogram("dd_sql_rows_returned", "Rows fetched per statement.", ROW_BUCKETS, ("statement",))
+PDF_SECONDS = Histogram("dd_pdf_render_seconds", "PDF render time.", TIME_BUCKETS, ("report",))
+PDF_PAGES = Histogram("dd_pdf_pages", "Pages per rendered PDF.", PAGE_BUCKETS, ("report",))
+PDF_BYTES = Histogram("dd_pdf_bytes", "Size of each rendered PDF.", BYTE_BUCKETS, ("report",))
+
+def record_query(sql, seconds, rows):
+    words = sql.split(None, 1)
+    statement = words[0].upper() if words else ""
+    QUERY_SECONDS.observe(seconds, statement); QUERY_ROWS.observe(rows, statement)
+    if has_app_context():
+        stats = g.setdefault("_sql_stats", [0, 0.0, 0])
+        stats[0] += 1; stats[1] += seconds; stats[2] += rows
+    if seconds*1000 >= SLOW_QUERY_MS:
+        slow_log.warning("slow query: %.1f ms, %d rows: %s", seconds*1000, rows, " ".join(sql.split())[:500])
+
+def record_pdf(report, seconds, pages, size):
+    PDF_SECONDS.observe(seconds, report); PDF_PAGES.observe(pages, report); PDF_BYTES.observe(size, report)
+    if has_app_context():
+        g._pdf_seconds = g.get("_pdf_seconds", 0.0) + seconds
+
+class TimedCursor(sqlite3.Cursor):
+    # Times a statement from execute() until its rows run out or the cursor is reused, closed or dropped.
+    _sql = None
+
+    def execute(self, sql, params=()):
+        self._finish()
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            self._sql, self._rows, self._elapsed = sql, 0, time.perf_counter() - started
+
+    def executemany(self, sql, seq):
+        self._finish()
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq)
+        finally:
+            self._sql, self._rows, self._elapsed = sql, 0, time.perf_counter() - started
+            self._finish()
+
+    def __next__(self):
+        # Rows read by iteration are counted but not timed one by one (that would double the cost of a
+        # large scan); the statement's time is execute() plus any fetch*() calls.
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._finish()
+            raise
+        self._rows += 1
+        return row
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._elapsed += time.perf_counter() - started
+        if row is None: self._finish()
+        else: self._rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        started = time.perf_counter()
+        rows = super().fetchmany(size)
+        self._elapsed += time.perf_counter() - started; self._rows += len(rows)
+        if len(rows) < size: self._finish()
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._elapsed += time.perf_counter() - started; self._rows += len(rows)
+        self._finish()
+        return rows
+
+    def close(self):
+        self._finish(); super().close()
+
+    def __del__(self):
+        self._finish()
+
+    def _finish(self):
+        if self._sql is not None:
+            sql, self._sql = self._sql, None
+            record_query(sql, self._elapsed, self._rows)
+
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq):
+        return self.cursor().executemany(sql, seq)
+
+# ---------- Database ----------
+# Applied to every connection; journal_mode=WAL is persistent and set once by init_db().
+# A process waiting for another's migration (FTS rebuilds, cents conversion) allows it this long.
+MIGRATION_WAIT_MS = 10 * 60 * 1000
+DB_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=134217728",
+)
+
+def connect_db(readonly=False):
+    # URI filenames on both, so attach_archives() can open the archive files with mode=ro.
+    uri = pathlib.Path(DB_PATH).resolve().as_uri() + ("?mode=ro" if readonly else "")
+    conn = sqlite3.connect(uri, uri=True, timeout=5, factory=TimedConnection)
     conn.row_factory = sqlite3.Row
+    for pragma in DB_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+def get_db(readonly=False):
+    # Inside a request the connection is reused until close_db() runs on teardown;
+    # outside one (init_db, scripts) the caller owns and closes it.
+    if not has_app_context():
+        return connect_db(readonly)
+    key = "_db_ro" if readonly else "_db"
+    conn = g.get(key)
+    if conn is None:
+        conn = connect_db(readonly)
+        setattr(g, key, conn)
     return conn
 
 def init_db():
-    with closing(get_db()) as db:
+    # Runs on import, i.e. once in the gunicorn master under --preload or in every worker without it.
+    # An up-to-date database is only read (PRAGMA user_version); otherwise the schema is created/migrated
+    # under BEGIN IMMEDIATE and user_version re-read once the lock is held, so when several processes
+    # start together one migrates and the rest wait for it, then find nothing left to do.
+    # Returns True when it changed the schema.
+    with closing(connect_db()) as db:
+        if db.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+            return False
+        db.execute(f"PRAGMA busy_timeout={MIGRATION_WAIT_MS}")
+        db.execute("PRAGMA journal_mode=WAL")
         c = db.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        if c.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+            db.rollback()
+            return False
         c.execute("CREATE TABLE IF NOT EXISTS trucks (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE NOT NULL)")
         c.execute("CREATE TABLE IF NOT EXISTS drivers (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE NOT NULL)")
         c.execute("""
@@ -50,29 +242,789 @@ def init_db():
                 FOREIGN KEY (driver_id) REFERENCES drivers(id)
             )
         """)
+        # Per month x truck x driver x income/expense sums, kept in step with entries by rollup_entry()
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS ledger_rollups (
+                month TEXT NOT NULL,
+                truck_id INTEGER NOT NULL DEFAULT 0,
+                driver_id INTEGER NOT NULL DEFAULT 0,
+                is_income INTEGER NOT NULL,
+                amount REAL NOT NULL DEFAULT 0,
+                entries INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (month, truck_id, driver_id, is_income)
+            ) WITHOUT ROWID
+        """)
+        # A migration returns True when it has changed what the rollups are built from.
+        version = c.execute("PRAGMA user_version").fetchone()[0]
+        rebuild = False
+        for target, migrate in MIGRATIONS:
+            if target > version:
+                rebuild = migrate(c) or rebuild
+                c.execute(f"PRAGMA user_version={target}")
+        if rebuild or not c.execute("SELECT 1 FROM ledger_rollups LIMIT 1").fetchone():
+            rebuild_rollups(c)
         db.commit()
+        return True
 
-def amount_with_hst(amount, hst_included):
-    return amount if hst_included else round(amount*1.13, 2)
+# ---------- Schema migrations (tracked in PRAGMA user_version) ----------
+DATE_FORMATS = ("%Y/%m/%d", "%m/%d/%Y", "%d-%m-%Y", "%B %d, %Y")
+migrate_log = logging.getLogger("dd.migrate")
 
-def totals(where="", params=()):
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(f"SELECT is_income, amount, hst_included FROM entries {('WHERE '+where) if where else ''}", params)
-    income = 0.0
-    expense = 0.0
-    for r in c.fetchall():
-        if r["is_income"] == 1:
-            income += float(r["amount"])
-        else:
-            expense += float(amount_with_hst(r["amount"], bool(r["hst_included"])))
-    conn.close()
-    return income, expense, round(income-expense, 2)
+def iso_date(value):
+    # 'YYYY-MM-DD', or None for anything that isn't a date string in one of the accepted formats.
+    value = value.strip() if isinstance(value, str) else ""
+    try:
+        return date.fromisoformat(value[:10]).isoformat()
+    except ValueError:
+        pass
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).date().isoformat()
+        except ValueError:
+            continue
+    return None
+
+def migrate_1_iso_dates_and_indexes(c):
+    # Store entry_date as plain 'YYYY-MM-DD' so range predicates can use an index instead of date(entry_date).
+    rows = c.execute("SELECT id, entry_date FROM entries WHERE date(entry_date) IS NOT entry_date").fetchall()
+    fixed = [(iso_date(r["entry_date"]), r["id"]) for r in rows]
+    c.executemany("UPDATE entries SET entry_date=? WHERE id=?", [f for f in fixed if f[0]])
+    # Left as they are (they sort outside every ISO range) for someone to correct by hand.
+    bad = [(r["id"], r["entry_date"]) for r, f in zip(rows, fixed) if not f[0]]
+    if bad:
+        migrate_log.warning("%d entries have an unrecognised entry_date and were not converted: %s",
+                            len(bad), ", ".join(f"id {i}: {d!r}" for i, d in bad[:50]) + (" ..." if len(bad) > 50 else ""))
+    create_entry_indexes(c)
+    return bool(rows)
+
+def create_entry_indexes(c):
+    c.execute("CREATE INDEX IF NOT EXISTS idx_entries_date_id ON entries(entry_date, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_entries_truck_date ON entries(truck_id, entry_date)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_entries_category_driver_date ON entries(category, driver_id, entry_date)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_entries_category_date ON entries(category, entry_date) WHERE category='Driver Pay'")
+
+def migrate_2_data_versions(c):
+    c.execute("CREATE TABLE IF NOT EXISTS data_versions (scope TEXT PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID")
+
+def migrate_3_report_jobs(c):
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS report_jobs (
+            id TEXT PRIMARY KEY,
+            job_key TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            status TEXT NOT NULL,
+            fname TEXT,
+            error TEXT,
+            created TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            finished TEXT
+        )
+    """)
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_report_jobs_pending ON report_jobs(job_key) WHERE status IN ('queued','running')")
+
+def migrate_4_integer_cents(c):
+    # entries.amount REAL -> entries.amount_cents INTEGER; the rollups are recreated in cents and every
+    # cached report is invalidated, since HST is now rounded by the rule in the Money section.
+    seq = c.execute("SELECT seq FROM sqlite_sequence WHERE name='entries'").fetchone()
+    c.execute("ALTER TABLE entries RENAME TO entries_real")
+    c.execute("""
+        CREATE TABLE entries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            entry_date TEXT NOT NULL,
+            is_income INTEGER NOT NULL,
+            category TEXT,
+            amount_cents INTEGER NOT NULL,
+            hst_included INTEGER DEFAULT 1,
+            description TEXT,
+            truck_id INTEGER,
+            driver_id INTEGER,
+            FOREIGN KEY (truck_id) REFERENCES trucks(id),
+            FOREIGN KEY (driver_id) REFERENCES drivers(id)
+        )
+    """)
+    c.execute("""
+        INSERT INTO entries(id, entry_date, is_income, category, amount_cents, hst_included, description, truck_id, driver_id)
+        SELECT id, entry_date, is_income, category, CAST(round(amount*100) AS INTEGER), hst_included, description, truck_id, driver_id
+        FROM entries_real
+    """)
+    c.execute("DROP TABLE entries_real")
+    if seq and not c.execute("UPDATE sqlite_sequence SET seq=MAX(seq, ?) WHERE name='entries'", (seq[0],)).rowcount:
+        c.execute("INSERT INTO sqlite_sequence(name, seq) VALUES ('entries', ?)", (seq[0],))
+    create_entry_indexes(c)
+    c.execute("DROP TABLE ledger_rollups")
+    c.execute("""
+        CREATE TABLE ledger_rollups (
+            month TEXT NOT NULL,
+            truck_id INTEGER NOT NULL DEFAULT 0,
+            driver_id INTEGER NOT NULL DEFAULT 0,
+            is_income INTEGER NOT NULL,
+            amount_cents INTEGER NOT NULL DEFAULT 0,
+            entries INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (month, truck_id, driver_id, is_income)
+        ) WITHOUT ROWID
+    """)
+    bump_version(c, "ref")
+    return True
+
+def migrate_5_tax_rollups(c):
+    # Per month x truck x category x income/expense HST, for the HST return report.
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS tax_rollups (
+            month TEXT NOT NULL,
+            truck_id INTEGER NOT NULL DEFAULT 0,
+            category TEXT NOT NULL DEFAULT '',
+            is_income INTEGER NOT NULL,
+            hst_cents INTEGER NOT NULL DEFAULT 0,
+            entries INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (month, truck_id, category, is_income)
+        ) WITHOUT ROWID
+    """)
+    return True
+
+def migrate_6_entries_fts(c):
+    # External-content FTS5 index over description and category; the triggers keep it in step with entries.
+    c.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts USING fts5(
+            description, category, content='entries', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS entries_fts_insert AFTER INSERT ON entries BEGIN
+            INSERT INTO entries_fts(rowid, description, category) VALUES (new.id, new.description, new.category);
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS entries_fts_delete AFTER DELETE ON entries BEGIN
+            INSERT INTO entries_fts(entries_fts, rowid, description, category) VALUES ('delete', old.id, old.description, old.category);
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS entries_fts_update AFTER UPDATE OF description, category ON entries BEGIN
+            INSERT INTO entries_fts(entries_fts, rowid, description, category) VALUES ('delete', old.id, old.description, old.category);
+            INSERT INTO entries_fts(rowid, description, category) VALUES (new.id, new.description, new.category);
+        END
+    """)
+    c.execute("INSERT INTO entries_fts(entries_fts) VALUES ('rebuild')")
+
+def migrate_7_idempotency_keys(c):
+    # Client-generated keys of entries submitted through /api/entries/batch, so a retried batch is not stored twice.
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            key TEXT PRIMARY KEY,
+            entry_id INTEGER NOT NULL,
+            fingerprint TEXT NOT NULL,
+            created TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        ) WITHOUT ROWID
+    """)
+
+def migrate_8_archived_years(c):
+    # Closed years moved out to ARCHIVE_DIR by `flask archive`; the triggers keep entries from being added to
+    # an archived year or moved into one. Their ledger_rollups/tax_rollups rows stay here, frozen.
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS archived_years (
+            year TEXT PRIMARY KEY,
+            file TEXT NOT NULL,
+            entries INTEGER NOT NULL,
+            amount_cents INTEGER NOT NULL,
+            min_id INTEGER NOT NULL,
+            max_id INTEGER NOT NULL,
+            archived TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        ) WITHOUT ROWID
+    """)
+    for event in ("INSERT", "UPDATE OF entry_date"):
+        c.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS entries_archived_{event.split()[0].lower()} BEFORE {event} ON entries
+            WHEN EXISTS (SELECT 1 FROM archived_years WHERE year=substr(new.entry_date, 1, 4))
+            BEGIN SELECT RAISE(ABORT, 'entry date is in an archived year'); END
+        """)
+
+# (table, key column, other columns) whose writes the change_log triggers record.
+CHANGE_LOG_TABLES = (
+    ("entries", "id", ("entry_date", "is_income", "category", "amount_cents", "hst_included", "description", "truck_id", "driver_id")),
+    ("trucks", "id", ("name",)),
+    ("drivers", "id", ("name",)),
+    ("archived_years", "year", ("file", "entries", "amount_cents", "min_id", "max_id", "archived")),
+    ("idempotency_keys", "key", ("entry_id", "fingerprint", "created")),
+)
+
+def change_log_json(key, cols, row):
+    return "json_object(" + ", ".join(f"'{col}', {row}.{col}" for col in (key, *cols)) + ")"
+
+def change_log_triggers(c, create=True):
+    # (Re)creates the triggers, or only drops them. They log nothing until backups are enabled (the first full
+    # backup sets backups_enabled), and entries inserted by flush_import() are logged per batch instead.
+    for table, key, cols in CHANGE_LOG_TABLES:
+        for op in ("INSERT", "UPDATE", "DELETE"):
+            name = f"{table}_log_{op.lower()}"
+            c.execute(f"DROP TRIGGER IF EXISTS {name}")
+            if not create: continue
+            row = "old" if op == "DELETE" else "new"
+            data = "NULL" if op == "DELETE" else change_log_json(key, cols, "new")
+            when = "EXISTS (SELECT 1 FROM backups_enabled)" + (" AND NOT EXISTS (SELECT 1 FROM bulk_insert)" if (table, op) == ("entries", "INSERT") else "")
+            c.execute(f"""
+                CREATE TRIGGER {name} AFTER {op} ON {table} WHEN {when}
+                BEGIN INSERT INTO change_log(tbl, op, row_key, data) VALUES ('{table}', '{op[0]}', {row}.{key}, {data}); END
+            """)
+
+LOG_INSERTED_SQL = f"""
+    INSERT INTO change_log(tbl, op, row_key, data)
+    SELECT 'entries', 'I', id, {change_log_json(*CHANGE_LOG_TABLES[0][1:], "entries")} FROM entries
+    WHERE id>? AND EXISTS (SELECT 1 FROM backups_enabled) ORDER BY id
+"""
+
+def migrate_9_change_log(c):
+    # Append-only record of every write to CHANGE_LOG_TABLES, shipped by incremental backups and replayed by
+    # point-in-time restores (see Backups). data is the row as written, NULL for a delete; rows already in a
+    # backup file are dropped by prune_change_log().
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS change_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ', 'now')),
+            tbl TEXT NOT NULL,
+            op TEXT NOT NULL,
+            row_key NOT NULL,
+            data TEXT
+        )
+    """)
+    change_log_triggers(c)
+
+def migrate_10_truck_rollups(c):
+    # Per month x truck x income/expense sums for the dashboard and per-truck totals, which don't need the
+    # driver grain of ledger_rollups. Built from ledger_rollups so archived years' frozen months are included.
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS truck_rollups (
+            month TEXT NOT NULL,
+            truck_id INTEGER NOT NULL DEFAULT 0,
+            is_income INTEGER NOT NULL,
+            amount_cents INTEGER NOT NULL DEFAULT 0,
+            entries INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (month, truck_id, is_income)
+        ) WITHOUT ROWID
+    """)
+    c.execute("""INSERT INTO truck_rollups(month, truck_id, is_income, amount_cents, entries)
+                 SELECT month, truck_id, is_income, SUM(amount_cents), SUM(entries) FROM ledger_rollups GROUP BY 1, 2, 3""")
+
+def migrate_11_bulk_insert(c):
+    # flush_import() sets the bulk_insert flag inside its own write transaction (so no other connection ever
+    # sees it), inserts a batch with the per-row index trigger skipped, and indexes the batch in one statement.
+    c.execute("CREATE TABLE IF NOT EXISTS bulk_insert (active INTEGER PRIMARY KEY)")
+    c.execute("DROP TRIGGER IF EXISTS entries_fts_insert")
+    c.execute("""
+        CREATE TRIGGER entries_fts_insert AFTER INSERT ON entries WHEN NOT EXISTS (SELECT 1 FROM bulk_insert) BEGIN
+            INSERT INTO entries_fts(rowid, description, category) VALUES (new.id, new.description, new.category);
+        END
+    """)
+
+def migrate_12_backups_enabled(c):
+    # change_log is only written while backups are in use: the first full backup sets the flag and
+    # prune_change_log() clears it (and the log) when BACKUP_DIR holds no backups.
+    c.execute("CREATE TABLE IF NOT EXISTS backups_enabled (active INTEGER PRIMARY KEY)")
+    if glob.glob(os.path.join(BACKUP_DIR, "*.json")):
+        c.execute("INSERT OR IGNORE INTO backups_enabled VALUES (1)")
+    else:
+        c.execute("DELETE FROM change_log")
+    change_log_triggers(c)
+
+def migrate_13_category_date_index(c):
+    # driver_pay for all drivers could only seek category=? on (category, driver_id, entry_date) and read
+    # every Driver Pay row ever written. Partial, so other rows (and bulk imports) don't pay for it.
+    create_entry_indexes(c)
+
+MIGRATIONS = [
+    (1, migrate_1_iso_dates_and_indexes),
+    (2, migrate_2_data_versions),
+    (3, migrate_3_report_jobs),
+    (4, migrate_4_integer_cents),
+    (5, migrate_5_tax_rollups),
+    (6, migrate_6_entries_fts),
+    (7, migrate_7_idempotency_keys),
+    (8, migrate_8_archived_years),
+    (9, migrate_9_change_log),
+    (10, migrate_10_truck_rollups),
+    (11, migrate_11_bulk_insert),
+    (12, migrate_12_backups_enabled),
+    (13, migrate_13_category_date_index),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# ---------- Money ----------
+# Amounts are stored as integer cents and summed inside SQLite, so totals are exact to the cent however
+# many rows they cover. The one HST rule: an expense entered without HST gets 13% added, rounded half-up
+# to the cent per entry, i.e. cents + (cents*13 + 50) / 100 in integer arithmetic. Income and amounts
+# entered with HST count as entered. GROSS_CENTS is that rule as SQL; format it with e="e." or e="".
+GROSS_CENTS = "CASE WHEN {e}is_income=1 OR {e}hst_included=1 THEN {e}amount_cents ELSE {e}amount_cents + ({e}amount_cents*13 + 50) / 100 END"
+# The HST inside GROSS_CENTS: 13/113 of an amount entered with HST (all income is), rounded half-up per
+# entry, or exactly the 13% GROSS_CENTS added to an expense entered without it.
+HST_CENTS = "CASE WHEN {e}is_income=1 OR {e}hst_included=1 THEN ({e}amount_cents*26 + 113) / 226 ELSE ({e}amount_cents*13 + 50) / 100 END"
+
+# Largest amount accepted, in dollars; keeps cents, and sums of them, well inside SQLite's 64-bit integers.
+MAX_AMOUNT = 10**9
+
+def to_cents(value):
+    # "1,234.565" -> 123457 (half-up); 0 for anything that is not a finite number up to MAX_AMOUNT.
+    try:
+        d = Decimal(str(value if value is not None else "").replace(",", "").replace("$", "").strip())
+    except InvalidOperation:
+        return 0
+    if not d.is_finite() or d.copy_abs() > MAX_AMOUNT:
+        return 0
+    return int((d * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+def fmt_cents(cents):
+    return f"${'-' if cents < 0 else ''}{abs(cents)//100:,}.{abs(cents)%100:02d}"
+
+
+# ---------- Entry queries (shared with the `explain` command) ----------
+# {entries} is "entries", or the ledger_source() covering the archived years a date range reaches.
+ENTRY_JOIN = """
+    FROM {entries} e
+    LEFT JOIN trucks t ON e.truck_id = t.id
+    LEFT JOIN drivers d ON e.driver_id = d.id
+"""
+ENTRY_COLUMNS = f"e.*, e.amount_cents/100.0 AS amount, {GROSS_CENTS.format(e='e.')} AS gross_cents, t.name AS truck_name, d.name AS driver_name"
+RECENT_ENTRIES_SQL = f"""
+    SELECT {ENTRY_COLUMNS} {ENTRY_JOIN.format(entries='entries')}
+    ORDER BY e.entry_date DESC, e.id DESC
+    LIMIT 10
+"""
+# Keyset-paginated on (entry_date, id): {order} is DESC for the next page, ASC when paging back.
+ENTRY_PAGE_SIZE = 200
+ENTRY_LIST_SQL = f"""
+    SELECT {ENTRY_COLUMNS} {ENTRY_JOIN}
+    {{where}}
+    ORDER BY e.entry_date {{order}}, e.id {{order}}
+    LIMIT ?
+"""
+MONTHLY_ALL_SQL = f"""
+    SELECT {ENTRY_COLUMNS} {ENTRY_JOIN}
+    WHERE e.entry_date>=? AND e.entry_date<?
+    ORDER BY t.name ASC, e.truck_id ASC, e.entry_date ASC, e.id ASC
+"""
+MONTHLY_TRUCK_SQL = f"""
+    SELECT {ENTRY_COLUMNS} {ENTRY_JOIN}
+    WHERE e.entry_date>=? AND e.entry_date<? AND e.truck_id=?
+    ORDER BY e.entry_date ASC, e.id ASC
+"""
+DRIVER_PAY_SQL = f"""
+    SELECT {ENTRY_COLUMNS} {ENTRY_JOIN}
+    WHERE e.is_income=0 AND e.category='Driver Pay' AND e.entry_date>=? AND e.entry_date<=? {{driver}}
+    ORDER BY e.entry_date ASC, e.id ASC
+"""
+# Full-text matches ranked by bm25 (description weighs double); {filters} takes entry_filters() clauses.
+SEARCH_SQL = f"""
+    SELECT {ENTRY_COLUMNS}, bm25(entries_fts, 2.0, 1.0) AS rank
+    FROM entries_fts JOIN entries e ON e.id = entries_fts.rowid
+    LEFT JOIN trucks t ON e.truck_id = t.id
+    LEFT JOIN drivers d ON e.driver_id = d.id
+    WHERE entries_fts MATCH ? {{filters}}
+    ORDER BY rank, e.entry_date DESC, e.id DESC
+    LIMIT ? OFFSET ?
+"""
+DRIVER_PAY_TOTAL_SQL = f"""
+    SELECT IFNULL(SUM({GROSS_CENTS.format(e='e.')}), 0) FROM {{entries}} e
+    WHERE e.is_income=0 AND e.category='Driver Pay' AND e.entry_date>=? AND e.entry_date<=? {{driver}}
+"""
+
+def query_plans():
+    # (route, sql, sample params) for every entries query a page runs
+    today = date.today()
+    month_start = str(today.replace(day=1)); month_end = str(today.replace(day=28))
+    return [
+        ("home", RECENT_ENTRIES_SQL, ()),
+        ("expense_income", ENTRY_LIST_SQL.format(entries="entries", where="", order="DESC"), (ENTRY_PAGE_SIZE+1,)),
+        ("expense_income (from/to)", ENTRY_LIST_SQL.format(entries="entries", where="WHERE e.entry_date>=? AND e.entry_date<=?", order="DESC"), (month_start, month_end, ENTRY_PAGE_SIZE+1)),
+        ("expense_income (next page)", ENTRY_LIST_SQL.format(entries="entries", where="WHERE (e.entry_date, e.id) < (?, ?)", order="DESC"), (month_end, 1000, ENTRY_PAGE_SIZE+1)),
+        ("expense_income (truck, next page)", ENTRY_LIST_SQL.format(entries="entries", where="WHERE e.truck_id=? AND (e.entry_date, e.id) < (?, ?)", order="DESC"), (1, month_end, 1000, ENTRY_PAGE_SIZE+1)),
+        ("monthly_reports (all)", MONTHLY_ALL_SQL.format(entries="entries"), (month_start, month_end)),
+        ("monthly_reports (truck)", MONTHLY_TRUCK_SQL.format(entries="entries"), (month_start, month_end, 1)),
+        ("driver_pay (all)", DRIVER_PAY_SQL.format(entries="entries", driver=""), (month_start, month_end)),
+        ("driver_pay (driver)", DRIVER_PAY_SQL.format(entries="entries", driver="AND e.driver_id=?"), (month_start, month_end, 1)),
+        ("driver_pay (total)", DRIVER_PAY_TOTAL_SQL.format(entries="entries", driver="AND e.driver_id=?"), (month_start, month_end, 1)),
+        ("search", SEARCH_SQL.format(filters=" AND e.entry_date>=?"), ('"fuel"*', month_start, SEARCH_PAGE_SIZE+1, 0)),
+    ]
+
+# ---------- Ledger rollups ----------
+# ledger_rollups sums GROSS_CENTS (income at face value, expenses with HST added when it was not included);
+# truck_rollups is the same sum without the driver, for totals(); tax_rollups sums HST_CENTS. All are kept in
+# step with entries in the same transaction. Rows for archived
+# years are frozen: their entries live in the archive files, so rebuilds and checks leave those months alone.
+ROLLUP_MONTH = "IFNULL(strftime('%Y-%m', entry_date), '')"
+HOT_MONTHS = "substr(month, 1, 4) NOT IN (SELECT year FROM archived_years)"
+ROLLUP_GROUPED = f"""
+    SELECT {ROLLUP_MONTH} AS month, IFNULL(truck_id,0) AS truck_id, IFNULL(driver_id,0) AS driver_id, is_income,
+           SUM({GROSS_CENTS.format(e='')}) AS amount_cents, COUNT(*) AS entries
+    FROM entries {{where}} GROUP BY 1, 2, 3, 4
+"""
+TRUCK_ROLLUP_GROUPED = f"""
+    SELECT {ROLLUP_MONTH} AS month, IFNULL(truck_id,0) AS truck_id, is_income,
+           SUM({GROSS_CENTS.format(e='')}) AS amount_cents, COUNT(*) AS entries
+    FROM entries {{where}} GROUP BY 1, 2, 3
+"""
+TAX_ROLLUP_GROUPED = f"""
+    SELECT {ROLLUP_MONTH} AS month, IFNULL(truck_id,0) AS truck_id, IFNULL(category,'') AS category, is_income,
+           SUM({HST_CENTS.format(e='')}) AS hst_cents, COUNT(*) AS entries
+    FROM entries {{where}} GROUP BY 1, 2, 3, 4
+"""
+# (table, grouped query over entries, key columns, summed column)
+ROLLUP_TABLES = (
+    ("ledger_rollups", ROLLUP_GROUPED, ("month", "truck_id", "driver_id", "is_income"), "amount_cents"),
+    ("truck_rollups", TRUCK_ROLLUP_GROUPED, ("month", "truck_id", "is_income"), "amount_cents"),
+    ("tax_rollups", TAX_ROLLUP_GROUPED, ("month", "truck_id", "category", "is_income"), "hst_cents"),
+)
+
+ROLLUP_KEY_SQL = f"""
+    SELECT {ROLLUP_MONTH} AS month, IFNULL(truck_id,0) AS truck_id, IFNULL(driver_id,0) AS driver_id,
+           IFNULL(category,'') AS category, is_income FROM entries WHERE id=?
+"""
+
+def upsert_rollup(table, keys, value, select):
+    return f"""
+        INSERT INTO {table}({', '.join(keys)}, {value}, entries) {select}
+        ON CONFLICT({', '.join(keys)}) DO UPDATE SET {value}={value}+excluded.{value}, entries=entries+excluded.entries
+    """
+
+def rollup_entry(cur, entry_id, sign):
+    # sign=1 after an insert/update, sign=-1 before an update/delete; caller commits.
+    # Also bumps the month's data_versions row so cached reports for it go stale.
+    key = cur.execute(ROLLUP_KEY_SQL, (entry_id,)).fetchone() if sign < 0 else None
+    for table, grouped, keys, value in ROLLUP_TABLES:
+        select = f"SELECT {', '.join(keys)}, ?*{value}, ?*entries FROM ({grouped.format(where='WHERE id=?')}) WHERE true"
+        cur.execute(upsert_rollup(table, keys, value, select), (sign, sign, entry_id))
+        if key is not None:  # only this entry's row can have dropped to zero; a primary-key lookup
+            cur.execute(f"DELETE FROM {table} WHERE {' AND '.join(f'{k}=?' for k in keys)} AND entries<=0", [key[k] for k in keys])
+    cur.execute(f"""
+        INSERT INTO data_versions(scope, version) SELECT {ROLLUP_MONTH}, 1 FROM entries WHERE id=?
+        ON CONFLICT(scope) DO UPDATE SET version=version+1
+    """, (entry_id,))
+
+def rollup_since(cur, after_id):
+    # Batch form of rollup_entry(cur, id, 1) for every entry with id > after_id; the caller holds the write lock.
+    for table, grouped, keys, value in ROLLUP_TABLES:
+        cur.execute(upsert_rollup(table, keys, value, grouped.format(where='WHERE id>?')), (after_id,))
+    cur.execute(f"""
+        INSERT INTO data_versions(scope, version) SELECT DISTINCT {ROLLUP_MONTH}, 1 FROM entries WHERE id>?
+        ON CONFLICT(scope) DO UPDATE SET version=version+1
+    """, (after_id,))
+
+def bump_version(conn, scope):
+    # 'YYYY-MM' scopes are bumped by rollup_entry(); 'ref' covers trucks/drivers and is part of every stamp.
+    conn.execute("INSERT INTO data_versions(scope, version) VALUES (?, 1) ON CONFLICT(scope) DO UPDATE SET version=version+1", (scope,))
+
+def rebuild_rollups(cur):
+    for table, grouped, keys, value in ROLLUP_TABLES:
+        cur.execute(f"DELETE FROM {table} WHERE {HOT_MONTHS}")
+        cur.execute(f"INSERT INTO {table}({', '.join(keys)}, {value}, entries) {grouped.format(where='')}")
+
+def verify_rollups(cur, stored=HOT_MONTHS):
+    # stored: which rollup rows to check; an archive file, which has no archived_years, passes "true".
+    problems = []
+    for table, grouped, keys, value in ROLLUP_TABLES:
+        if not cur.execute("SELECT 1 FROM sqlite_master WHERE name=?", (table,)).fetchone():
+            continue  # an archive written before the table existed
+        key = lambda r: (table, *(r[k] for k in keys))
+        expected = {key(r): (r[value], r["entries"]) for r in cur.execute(grouped.format(where=''))}
+        rows = {key(r): (r[value], r["entries"]) for r in cur.execute(f"SELECT * FROM {table} WHERE {stored}")}
+        for k in sorted(set(expected) | set(rows), key=str):
+            want = expected.get(k, (0, 0)); got = rows.get(k, (0, 0))
+            if want != got:
+                problems.append((k, want, got))
+    return problems
+
+def totals(month_from=None, month_to=None, truck_id=None):
+    # (income, expenses, profit) in cents; month_from inclusive, month_to exclusive, both 'YYYY-MM'
+    where = []; params = []
+    if month_from: where.append("month>=?"); params.append(month_from)
+    if month_to: where.append("month<?"); params.append(month_to)
+    if truck_id: where.append("truck_id=?"); params.append(truck_id)
+    conn = get_db(readonly=True)
+    r = conn.execute(f"""
+        SELECT IFNULL(SUM(CASE WHEN is_income=1 THEN amount_cents END), 0) AS income,
+               IFNULL(SUM(CASE WHEN is_income=0 THEN amount_cents END), 0) AS expense
+        FROM truck_rollups {('WHERE '+' AND '.join(where)) if where else ''}
+    """, params).fetchone()
+    return r["income"], r["expense"], r["income"]-r["expense"]
+
+TRUCK_TOTALS_SQL = """
+    SELECT truck_id,
+           SUM(CASE WHEN is_income=1 THEN amount_cents ELSE 0 END) AS income,
+           SUM(CASE WHEN is_income=0 THEN amount_cents ELSE 0 END) AS expense
+    FROM truck_rollups WHERE month>=? AND month<? GROUP BY truck_id
+"""
+
+def truck_totals(conn, month_from, month_to):
+    # {entries.truck_id (0 for none): (income, expenses, profit) in cents} for every truck in one query.
+    return {r["truck_id"]: (r["income"], r["expense"], r["income"]-r["expense"])
+            for r in conn.execute(TRUCK_TOTALS_SQL, (month_from, month_to))}
+
+def sum_totals(values):
+    values = list(values)
+    income = sum(v[0] for v in values); expense = sum(v[1] for v in values)
+    return income, expense, income-expense
+
+# ---------- Entry validation (forms, bulk import) ----------
+ENTRY_FIELDS = ("entry_date", "is_income", "category", "amount_cents", "hst_included", "description", "truck_id", "driver_id")
+INSERT_ENTRY_SQL = f"INSERT INTO entries({','.join(ENTRY_FIELDS)}) VALUES ({','.join('?'*len(ENTRY_FIELDS))})"
+
+def clean_entry(f, closed=()):
+    # Normalises a dict of entry fields; returns (values in ENTRY_FIELDS order, list of error messages).
+    # closed: archived years ('YYYY'), which take no new or moved entries.
+    raw_date = f.get("entry_date")
+    entry_date = iso_date(raw_date)
+    amount = to_cents(f.get("amount"))
+    category = f.get("category") or "Other"
+    description = f.get("description") or ""
+    truck_id = f.get("truck_id") or None
+    driver_id = f.get("driver_id") or None
+    errors = []
+    # Form fields are always strings; JSON imports and the API can send anything.
+    if not isinstance(category, str): errors.append("Category must be text")
+    elif category.lower().strip() == "driver income": category = "Driver Pay"
+    if not raw_date: errors.append("Date is required")
+    elif not entry_date: errors.append("Date must be YYYY-MM-DD")
+    elif entry_date[:4] in closed: errors.append(f"{entry_date[:4]} is archived and closed to changes")
+    if amount <= 0: errors.append(f"Amount must be greater than 0 and at most {fmt_cents(MAX_AMOUNT * 100)}")
+    if not truck_id: errors.append("Truck is required")
+    if not driver_id: errors.append("Driver is required")
+    if not isinstance(description, str): errors.append("Description must be text")
+    elif not description.strip(): errors.append("Description is required")
+    row = (entry_date, int(f.get("is_income") or 0), category, amount, int(f.get("hst_included") or 0), description, truck_id, driver_id)
+    return row, errors
 
 app = Flask(__name__)
 app.secret_key = "dd-secret"
+
+@app.teardown_appcontext
+def close_db(exc):
+    for key in ("_db", "_db_ro"):
+        conn = g.pop(key, None)
+        if conn is not None:
+            conn.close()
+
 init_db()
-os.makedirs(REPORTS_DIR, exist_ok=True)
+
+@app.cli.command("rollups")
+@click.option("--verify", is_flag=True, help="Compare stored rollups with entries instead of rebuilding.")
+def rollups_command(verify):
+    """Rebuild (or verify) ledger_rollups, truck_rollups and tax_rollups from the entries table."""
+    db = get_db()
+    if verify:
+        problems = verify_rollups(db.cursor())
+        for k, want, got in problems:
+            click.echo(f"mismatch {k}: expected {want}, stored {got}")
+        click.echo("rollups OK" if not problems else f"{len(problems)} rollup rows out of date")
+        if problems: raise SystemExit(1)
+        return
+    rebuild_rollups(db.cursor()); bump_version(db, "ref"); db.commit()
+    click.echo("rollups rebuilt")
+
+def plan_ok(sql, plan):
+    # Entries must be read by a SEARCH on the rowid or an index, bounded by the date when the query filters
+    # on it. A SCAN, even in index order, passes only for a LIMITed read with no sort, which stops after a page.
+    on_entries = [p for p in plan if p.startswith(("SCAN e ", "SEARCH e "))]
+    dated = re.search(r"entry_date(, e\.id\))?\s*[<>]", sql)
+    limited = "LIMIT" in sql and not any("TEMP B-TREE FOR ORDER BY" in p for p in plan)
+    def line_ok(p):
+        if p.startswith("SCAN e "):
+            return limited and "USING" in p and "INDEX" in p
+        if "USING INDEX" in p or "USING COVERING INDEX" in p:
+            return not dated or "entry_date" in p
+        return "PRIMARY KEY" in p
+    return bool(on_entries) and all(map(line_ok, on_entries))
+
+@app.cli.command("explain")
+def explain_command():
+    """Print EXPLAIN QUERY PLAN for each route's entries query and fail if any scans the table."""
+    failed = []
+    db = get_db(readonly=True)
+    for route, sql, params in query_plans():
+        plan = [r["detail"] for r in db.execute("EXPLAIN QUERY PLAN " + sql, params)]
+        ok = plan_ok(sql, plan)
+        click.echo(f"{'ok  ' if ok else 'SCAN'} {route}")
+        for p in plan:
+            click.echo(f"       {p}")
+        if not ok: failed.append(route)
+    if failed:
+        raise SystemExit(f"full scan of entries in: {', '.join(failed)}")
+
+# ---------- Archived years ----------
+# `flask archive YEAR` moves a closed year's entries into ARCHIVE_DIR/entries_YYYY.db (same schema and
+# indexes, plus a frozen copy of its rollup rows) so the hot entries table only holds open years.
+# Queries for a date range that reaches an archived year read it through ledger_source(), which
+# ATTACHes the archive read-only for that connection. SQLite allows 10 attached databases, so a single
+# query can span up to ten archived years; the export, which can ask for everything, reads ledger_spans()
+# one after another instead.
+MAX_ATTACHED_ARCHIVES = 10
+_archived_years = None
+
+def archived_years(conn):
+    # {'YYYY': archived_years row}; cached per process like ref_lists() (archiving bumps 'ref').
+    global _archived_years
+    version = data_version(conn, "ref")
+    cached = _archived_years
+    if cached is None or cached[0] != version:
+        cached = _archived_years = (version, {r["year"]: r for r in conn.execute("SELECT * FROM archived_years")})
+    return cached[1]
+
+def archive_path(year):
+    return os.path.join(ARCHIVE_DIR, f"entries_{year}.db")
+
+def attach_archives(conn, years):
+    attached = {r[1] for r in conn.execute("PRAGMA database_list")}
+    for year in years:
+        if f"arch_{year}" not in attached:
+            conn.execute(f"ATTACH ? AS arch_{year}", (pathlib.Path(archive_path(year)).resolve().as_uri() + "?mode=ro",))
+
+def ledger_source(conn, date_from=None, date_to=None):
+    # What {entries} should read for entries between two ISO dates (inclusive, either may be None): plain
+    # "entries" unless an archived year overlaps, else that archive alone or a temp view over every part.
+    closed = archived_years(conn)
+    lo = (date_from or "0000")[:4]; hi = (date_to or "9999")[:4]
+    years = [y for y in sorted(closed) if lo <= y <= hi]
+    if not years:
+        return "entries"
+    if len(years) > MAX_ATTACHED_ARCHIVES:
+        raise ValueError(f"That date range reaches {len(years)} archived years; at most {MAX_ATTACHED_ARCHIVES} can be read at once.")
+    attach_archives(conn, years)
+    parts = [f"arch_{y}.entries" for y in years]
+    if not (date_from and date_to and all(str(y) in closed for y in range(int(lo), int(hi) + 1))):
+        parts.append("main.entries")
+    if len(parts) == 1:
+        return parts[0]
+    view = "ledger_" + "_".join(years) + ("_main" if parts[-1] == "main.entries" else "")
+    conn.execute(f"CREATE TEMP VIEW IF NOT EXISTS {view} AS " + " UNION ALL ".join(f"SELECT * FROM {p}" for p in parts))
+    return view
+
+def ledger_spans(conn, date_from=None, date_to=None):
+    # The date range split into consecutive (from, to) parts that each reach at most MAX_ATTACHED_ARCHIVES
+    # archived years; the range itself when it already does.
+    lo = (date_from or "0000")[:4]; hi = (date_to or "9999")[:4]
+    starts = [y for y in sorted(archived_years(conn)) if lo <= y <= hi][::MAX_ATTACHED_ARCHIVES]
+    if len(starts) <= 1:
+        return [(date_from, date_to)]
+    return [(date_from if i == 0 else f"{y}-01-01", f"{int(starts[i+1]) - 1}-12-31" if i + 1 < len(starts) else date_to)
+            for i, y in enumerate(starts)]
+
+def detach_archives(conn):
+    # Undoes ledger_source() on a connection: its temp views, then the attached archives.
+    for r in conn.execute("SELECT name FROM sqlite_temp_master WHERE type='view' AND name LIKE 'ledger%'").fetchall():
+        conn.execute(f"DROP VIEW temp.{r[0]}")
+    for r in conn.execute("PRAGMA database_list").fetchall():
+        if r[1].startswith("arch_"): conn.execute(f"DETACH {r[1]}")
+
+def archived_entry(conn, id):
+    # The archived year holding entry `id`, or None when it is not archived.
+    if conn.execute("SELECT 1 FROM entries WHERE id=?", (id,)).fetchone():
+        return None
+    for year, info in archived_years(conn).items():
+        if info["min_id"] <= id <= info["max_id"]:
+            attach_archives(conn, [year])
+            if conn.execute(f"SELECT 1 FROM arch_{year}.entries WHERE id=?", (id,)).fetchone():
+                return year
+    return None
+
+ARCHIVE_CHECKSUM_SQL = "SELECT COUNT(*), IFNULL(SUM(amount_cents), 0), IFNULL(MIN(id), 0), IFNULL(MAX(id), 0) FROM entries WHERE entry_date>=? AND entry_date<?"
+
+def archive_year(conn, year):
+    # Returns the number of entries moved; ValueError when the year can't be archived.
+    if not re.fullmatch(r"\d{4}", year) or int(year) >= date.today().year:
+        raise ValueError(f"{year} is not a closed year.")
+    if year in archived_years(conn):
+        raise ValueError(f"{year} is already archived.")
+    span = (f"{year}-01-01", f"{int(year)+1}-01-01")
+    path = archive_path(year); tmp = f"{path}.{os.getpid()}.tmp"
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    # Build the file from a read-only attach of this database, then check under the write lock that the
+    # year is still exactly what was copied before deleting it here.
+    arch = sqlite3.connect(pathlib.Path(tmp).resolve().as_uri(), uri=True); arch.row_factory = sqlite3.Row
+    try:
+        arch.execute("ATTACH ? AS hot", (pathlib.Path(DB_PATH).resolve().as_uri() + "?mode=ro",))
+        for r in arch.execute("""SELECT sql FROM hot.sqlite_master WHERE tbl_name IN ('entries', 'ledger_rollups', 'truck_rollups', 'tax_rollups')
+                                 AND type IN ('table', 'index') AND sql IS NOT NULL ORDER BY type='index'""").fetchall():
+            arch.execute(r["sql"])
+        arch.execute("INSERT INTO entries SELECT * FROM hot.entries WHERE entry_date>=? AND entry_date<? ORDER BY id", span)
+        for table, grouped, keys, value in ROLLUP_TABLES:
+            arch.execute(f"INSERT INTO {table} SELECT * FROM hot.{table} WHERE substr(month, 1, 4)=?", (year,))
+        arch.commit()
+        arch.execute("DETACH hot")
+        checksum = tuple(arch.execute(ARCHIVE_CHECKSUM_SQL, span).fetchone())
+        if not checksum[0]:
+            raise ValueError(f"{year} has no entries.")
+        if verify_rollups(arch.cursor(), "true"):
+            raise ValueError(f"Rollups for {year} don't match its entries; run `flask rollups` first.")
+        arch.close(); arch = None
+        os.replace(tmp, path)
+    finally:
+        if arch is not None: arch.close()
+        if os.path.exists(tmp): os.remove(tmp)
+    cur = conn.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    if tuple(cur.execute(ARCHIVE_CHECKSUM_SQL, span).fetchone()) != checksum:
+        conn.rollback(); os.remove(path)
+        raise ValueError(f"Entries for {year} changed while archiving; run it again.")
+    cur.execute("DELETE FROM entries WHERE entry_date>=? AND entry_date<?", span)
+    cur.execute("INSERT INTO archived_years(year, file, entries, amount_cents, min_id, max_id) VALUES (?, ?, ?, ?, ?, ?)",
+                (year, os.path.basename(path), *checksum))
+    bump_version(cur, "ref")
+    conn.commit()
+    return checksum[0]
+
+def restore_year(conn, year):
+    # Moves an archived year back into entries and unlocks it; returns the number of entries restored.
+    if year not in archived_years(conn):
+        raise ValueError(f"{year} is not archived.")
+    attach_archives(conn, [year])
+    cur = conn.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    cur.execute("DELETE FROM archived_years WHERE year=?", (year,))
+    moved = cur.execute(f"INSERT INTO entries SELECT * FROM arch_{year}.entries ORDER BY id").rowcount
+    bump_version(cur, "ref")
+    conn.commit()
+    conn.execute(f"DETACH arch_{year}")
+    os.remove(archive_path(year))
+    return moved
+
+def verify_archives(conn):
+    # [(year, problem)] for archives missing, not matching the checksum recorded when they were written,
+    # or whose rollups no longer match their entries.
+    problems = []
+    for year, info in sorted(archived_years(conn).items()):
+        if not os.path.exists(archive_path(year)):
+            problems.append((year, f"{archive_path(year)} is missing")); continue
+        arch = sqlite3.connect(pathlib.Path(archive_path(year)).resolve().as_uri() + "?mode=ro", uri=True)
+        arch.row_factory = sqlite3.Row
+        with closing(arch):
+            checksum = tuple(arch.execute(ARCHIVE_CHECKSUM_SQL, (f"{year}-01-01", f"{int(year)+1}-01-01")).fetchone())
+            if checksum != (info["entries"], info["amount_cents"], info["min_id"], info["max_id"]):
+                problems.append((year, f"checksum {checksum} differs from the recorded one"))
+            problems += [(year, f"rollup mismatch {k}: expected {want}, stored {got}") for k, want, got in verify_rollups(arch.cursor(), "true")]
+    return problems
+
+@app.cli.command("archive")
+@click.argument("year", required=False)
+@click.option("--restore", is_flag=True, help="Move YEAR back into the main database and unlock it.")
+@click.option("--verify", is_flag=True, help="Check every archive against its recorded checksum and rollups.")
+@click.option("--vacuum", is_flag=True, help="VACUUM the main database afterwards to give the freed space back.")
+def archive_command(year, restore, verify, vacuum):
+    """Move a closed year's entries into an archive file (or restore/verify archives)."""
+    db = get_db()
+    if verify:
+        for y, info in sorted(archived_years(db).items()):
+            click.echo(f"{y}: {info['entries']} entries in {info['file']} (archived {info['archived']})")
+        problems = verify_archives(db)
+        for y, problem in problems:
+            click.echo(f"{y}: {problem}")
+        click.echo("archives OK" if not problems else f"{len(problems)} archive problems")
+        if problems: raise SystemExit(1)
+        return
+    if not year:
+        raise click.UsageError("Give the year to archive or restore.")
+    try:
+        moved = restore_year(db, year) if restore else archive_year(db, year)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"{year}: {moved} entries {'restored' if restore else 'archived to ' + archive_path(year)}")
+    if vacuum:
+        db.execute("VACUUM")
 
 @app.template_filter("currency")
 def currency(v):
@@ -81,13 +1033,44 @@ def currency(v):
     except Exception:
         return v
 
+@app.before_request
+def start_request_timer():
+    g._started = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    started = g.pop("_started", None)
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    REQUEST_SECONDS.observe(elapsed, request.method, request.endpoint or "-", str(response.status_code))
+    if SERVER_TIMING:
+        queries, sql_seconds, rows = g.get("_sql_stats", (0, 0.0, 0))
+        timing = [f'db;dur={sql_seconds*1000:.1f};desc="{queries} queries, {rows} rows"']
+        if g.get("_pdf_seconds"): timing.append(f"pdf;dur={g._pdf_seconds*1000:.1f}")
+        timing.append(f"total;dur={elapsed*1000:.1f}")
+        response.headers["Server-Timing"] = ", ".join(timing)
+    return response
+
+@app.route("/metrics")
+def metrics():
+    # Scrapers have no login session: require_login lets this through only when a token is configured.
+    if not session.get("logged_in") and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return Response("forbidden\n", status=403, mimetype="text/plain")
+    body = "\n".join(line for h in METRICS for line in h.render()) + "\n"
+    return Response(body, mimetype="text/plain; version=0.0.4")
+
 # ---------- Auth ----------
 @app.before_request
 def require_login():
     allowed = ['login', 'static', 'download_report']
     if request.endpoint in allowed or (request.path or "").startswith('/static'):
         return
+    if request.endpoint == 'metrics' and METRICS_TOKEN:
+        return
     if not session.get('logged_in'):
+        if request.path.startswith('/api/'):
+            return jsonify(error="Login required."), 401
         return redirect(url_for('login'))
 
 @app.route("/login", methods=["GET","POST"])
@@ -111,107 +1094,225 @@ def logout():
     return redirect(url_for("login"))
 
 # ---------- PDF Helpers (footer, header) ----------
+# reportlab is imported by the functions that draw, so a worker only loads it when it first renders a PDF.
+inch = 72.0  # reportlab.lib.units.inch
+_logo = None
+
+def logo_image():
+    # Decoded once per process; None when the logo file is missing or unreadable.
+    global _logo
+    if _logo is None:
+        from reportlab.lib.utils import ImageReader
+        try:
+            _logo = ImageReader(os.path.join(BASE_DIR, LOGO_PATH)); _logo.getSize()
+        except Exception:
+            _logo = False
+    return _logo or None
+
 def draw_footer(c):
+    from reportlab.lib import colors
     c.setFont("Helvetica", 8)
     c.setFillColorRGB(0.40,0.40,0.40)
     footer = f"{COMPANY_NAME}  |  {COMPANY_ADDR}  |  {COMPANY_EMAIL}  |  {COMPANY_PHONES}"
     c.drawCentredString(4.25*inch, 0.55*inch, footer)
     c.setFillColor(colors.black)
 
+def draw_letterhead(c):
+    # Everything on the page that doesn't change: stored once per document as a form XObject.
+    if not getattr(c, "_dd_letterhead", False):
+        c.beginForm("dd_letterhead")
+        logo = logo_image()
+        if logo:
+            c.drawImage(logo, 0.6*inch, 9.6*inch, width=1.1*inch, height=1.1*inch, preserveAspectRatio=True, mask='auto')
+        c.setFont("Helvetica-Bold", 14)
+        c.drawCentredString(4.25*inch, 10.4*inch, COMPANY_NAME)
+        c.setFont("Helvetica", 10)
+        c.drawCentredString(4.25*inch, 10.15*inch, COMPANY_ADDR)
+        c.drawCentredString(4.25*inch, 9.95*inch, f"{COMPANY_EMAIL}    {COMPANY_PHONES}")
+        c.line(0.6*inch, 9.8*inch, 7.9*inch, 9.8*inch)
+        draw_footer(c)
+        c.endForm()
+        c._dd_letterhead = True
+    c.doForm("dd_letterhead")
+
 def header_pdf(c, title):
-    logo = os.path.join(BASE_DIR, LOGO_PATH)
-    if os.path.exists(logo):
-        c.drawImage(logo, 0.6*inch, 9.6*inch, width=1.1*inch, height=1.1*inch, preserveAspectRatio=True, mask='auto')
-    c.setFont("Helvetica-Bold", 14)
-    c.drawCentredString(4.25*inch, 10.4*inch, COMPANY_NAME)
-    c.setFont("Helvetica", 10)
-    c.drawCentredString(4.25*inch, 10.15*inch, COMPANY_ADDR)
-    c.drawCentredString(4.25*inch, 9.95*inch, f"{COMPANY_EMAIL}    {COMPANY_PHONES}")
-    c.line(0.6*inch, 9.8*inch, 7.9*inch, 9.8*inch)
+    draw_letterhead(c)
     c.setFont("Helvetica-Bold", 12)
     c.drawCentredString(4.25*inch, 9.55*inch, title)
     # Generated on line
     c.setFont("Helvetica-Bold", 10)
     c.drawCentredString(4.25*inch, 9.35*inch, f"Generated on: {datetime.now().strftime('%B %d, %Y')}")
-    draw_footer(c)
+
+# ---------- PDF table engine ----------
+# A column is (label, x in inches, "left"/"right", row -> text). Rows can be any iterable, e.g. a cursor,
+# so long reports are drawn as they are read.
+TABLE_TOP = 9.1*inch
+TABLE_BOTTOM = 1.1*inch
+ROW_HEIGHT = 0.15*inch
+
+def draw_table_header(c, title, columns):
+    header_pdf(c, title)
+    y = TABLE_TOP
+    c.setFont("Helvetica-Bold", 10)
+    for label, x, align, _ in columns:
+        (c.drawRightString if align == "right" else c.drawString)(x*inch, y, label)
+    c.setFont("Helvetica", 10)
+    return y - ROW_HEIGHT
+
+def draw_table(c, title, columns, rows):
+    # Starts on the current (blank) page and returns the y position below the last row.
+    y = draw_table_header(c, title, columns)
+    for r in rows:
+        if y < TABLE_BOTTOM:
+            c.showPage(); y = draw_table_header(c, title, columns)
+        for _, x, align, value in columns:
+            (c.drawRightString if align == "right" else c.drawString)(x*inch, y, value(r))
+        y -= ROW_HEIGHT
+    return y
+
+def draw_totals(c, title, y, lines, size=11):
+    # lines: (label, amount, colour by sign); moves to a fresh page if they would run into the footer.
+    from reportlab.lib import colors
+    if y - 0.1*inch - 0.18*inch*(len(lines)-1) < TABLE_BOTTOM:
+        c.showPage(); header_pdf(c, title); y = TABLE_TOP + 0.1*inch
+    y -= 0.1*inch; c.setFont("Helvetica-Bold", size)
+    for i, (label, amount, signed) in enumerate(lines):
+        if i: y -= 0.18*inch
+        if signed: c.setFillColor(colors.green if amount>=0 else colors.red)
+        c.drawRightString(6.9*inch, y, label); c.drawRightString(7.7*inch, y, fmt_cents(amount))
+        c.setFillColor(colors.black)
+    return y
+
+@contextmanager
+def pdf_canvas(out, report):
+    # Letter canvas for one report, saved when the block ends; records render time, pages and size.
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.pagesizes import letter
+    started = time.perf_counter()
+    c = canvas.Canvas(out, pagesize=letter)
+    yield c
+    pages = c.getPageNumber() - 1
+    c.save()
+    record_pdf(report, time.perf_counter() - started, pages, os.path.getsize(out) if isinstance(out, str) else out.tell())
+
+def peek_rows(rows):
+    # (None, None) for an empty iterable, else (first row, iterator over all rows).
+    rows = iter(rows)
+    first = next(rows, None)
+    return (None, None) if first is None else (first, itertools.chain([first], rows))
+
+# ---------- Reference data and conditional GET ----------
+# Each process keeps the truck and driver lists until the 'ref' data_versions row moves; every truck or
+# driver write bumps it, so an edit made through one gunicorn worker reaches the others on their next read.
+# Read-mostly pages answer If-None-Match with a 304 when their data-version stamp is unchanged.
+ETAG_SALT = str(max(os.path.getmtime(p) for p in [__file__, *glob.glob(os.path.join(BASE_DIR, "templates", "*.html"))]))
+_ref_lists = None
+
+def data_version(conn, scope=None):
+    # One scope's version, or a stamp that changes on any write to entries, trucks or drivers.
+    if scope:
+        r = conn.execute("SELECT version FROM data_versions WHERE scope=?", (scope,)).fetchone()
+        return r[0] if r else 0
+    r = conn.execute("SELECT COUNT(*), IFNULL(SUM(version), 0) FROM data_versions").fetchone()
+    return f"{r[0]}.{r[1]}"
+
+def ref_lists(conn):
+    # (trucks, drivers), each ordered by name.
+    global _ref_lists
+    version = data_version(conn, "ref")
+    cached = _ref_lists
+    if cached is None or cached[0] != version:
+        cached = _ref_lists = (version, (conn.execute("SELECT * FROM trucks ORDER BY name").fetchall(),
+                                         conn.execute("SELECT * FROM drivers ORDER BY name").fetchall()))
+    return cached[1]
+
+def not_modified(*stamp):
+    # A 304 when the browser already has the page for this stamp, else None after arranging for the ETag
+    # to go out with the rendered page. Skipped while flash messages are waiting to be shown.
+    if session.get("_flashes"):
+        return None
+    etag = hashlib.sha1(repr((ETAG_SALT, request.path, request.query_string, stamp)).encode()).hexdigest()[:24]
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={"ETag": f'"{etag}"', "Cache-Control": "private, no-cache"})
+    g._etag = etag
+    return None
+
+@app.after_request
+def add_etag(response):
+    if g.get("_etag") and response.status_code == 200:
+        response.set_etag(g._etag)
+        response.headers["Cache-Control"] = "private, no-cache"
+    return response
 
 # ---------- Pages ----------
 @app.route("/")
 def home():
-    conn = get_db()
-    income, expense, profit = totals()
+    conn = get_db(readonly=True)
+    if (cached := not_modified(data_version(conn))): return cached
+    income, expense, profit = (v/100 for v in totals())
     cur = conn.cursor()
-    cur.execute("""
-        SELECT e.*, t.name AS truck_name, d.name AS driver_name
-        FROM entries e
-        LEFT JOIN trucks t ON e.truck_id = t.id
-        LEFT JOIN drivers d ON e.driver_id = d.id
-        ORDER BY date(entry_date) DESC, id DESC
-        LIMIT 10
-    """)
+    cur.execute(RECENT_ENTRIES_SQL)
     recent = cur.fetchall()
-    conn.close()
     return render_template("home.html", title=APP_TITLE, income=income, expense=expense, profit=profit, recent=recent)
 
+def page_cursor(value):
+    # "YYYY-MM-DD_<id>" -> [entry_date, id], or None
+    m = re.fullmatch(r"(\d{4}-\d{2}-\d{2})_(\d+)", value or "")
+    return [m.group(1), int(m.group(2))] if m else None
+
+def cursor_of(row):
+    return f"{row['entry_date']}_{row['id']}"
+
 @app.route("/expense_income", methods=["GET","POST"])
 def expense_income():
-    conn = get_db()
+    conn = get_db(readonly=request.method == "GET")
     cur = conn.cursor()
     if request.method == "POST":
         form_type = request.form.get("form_type")
-        entry_date = request.form.get("entry_date")
-        description = request.form.get("description") or ""
-        truck_id = request.form.get("truck_id") or None
-        driver_id = request.form.get("driver_id") or None
-
+        fields = {k: request.form.get(k) for k in ("entry_date", "description", "truck_id", "driver_id")}
         if form_type == "income":
-            amount = float(request.form.get("income_amount") or 0)
-            is_income, category, hst_included = 1, "Income", 1
+            fields.update(amount=request.form.get("income_amount"), is_income=1, category="Income", hst_included=1)
         else:
-            amount = float(request.form.get("expense_amount") or 0)
-            is_income = 0
-            category = request.form.get("category") or "Other"
-            if category.lower().strip() == "driver income":
-                category = "Driver Pay"
-            hst_included = 1 if request.form.get("hst_option") == "with" else 0
-
-        errors = []
-        if not entry_date: errors.append("Date is required")
-        if not amount or amount <= 0: errors.append("Amount must be greater than 0")
-        if not truck_id: errors.append("Truck is required")
-        if not driver_id: errors.append("Driver is required")
-        if not description.strip(): errors.append("Description is required")
+            fields.update(amount=request.form.get("expense_amount"), is_income=0, category=request.form.get("category"),
+                          hst_included=1 if request.form.get("hst_option") == "with" else 0)
+        row, errors = clean_entry(fields, archived_years(conn))
         if errors:
             for e in errors: flash(e, "warning")
-            conn.close(); return redirect(url_for("expense_income"))
+            return redirect(url_for("expense_income"))
 
-        cur.execute("""
-            INSERT INTO entries(entry_date,is_income,category,amount,hst_included,description,truck_id,driver_id)
-            VALUES (?,?,?,?,?,?,?,?)
-        """, (entry_date, is_income, category, amount, hst_included, description, truck_id, driver_id))
+        cur.execute(INSERT_ENTRY_SQL, row)
+        rollup_entry(cur, cur.lastrowid, 1)
         conn.commit()
         flash("Saved!", "success")
         return redirect(url_for("expense_income"))
 
-    cur.execute("SELECT * FROM trucks ORDER BY name"); trucks = cur.fetchall()
-    cur.execute("SELECT * FROM drivers ORDER BY name"); drivers = cur.fetchall()
-    q_from = request.args.get('from'); q_to = request.args.get('to')
-    where = ""; params = []
-    if q_from:
-        where += (" WHERE date(entry_date)>=?" if not where else " AND date(entry_date)>=?"); params.append(q_from)
-    if q_to:
-        where += (" WHERE date(entry_date)<=?" if not where else " AND date(entry_date)<=?"); params.append(q_to)
-    cur.execute(f"""
-        SELECT e.*, t.name AS truck_name, d.name AS driver_name
-        FROM entries e
-        LEFT JOIN trucks t ON e.truck_id = t.id
-        LEFT JOIN drivers d ON e.driver_id = d.id
-        {where}
-        ORDER BY date(entry_date) DESC, id DESC
-        LIMIT 200
-    """, params); entries = cur.fetchall()
-    conn.close()
-    return render_template("expense_income.html", title=APP_TITLE, trucks=trucks, drivers=drivers, entries=entries)
+    if (cached := not_modified(data_version(conn))): return cached
+    clauses, params = entry_filters(request.args)
+    # Archived years are only read when the from/to filter asks for them.
+    q_from = iso_date(request.args.get("from")); q_to = iso_date(request.args.get("to"))
+    try:
+        source = ledger_source(conn, q_from, q_to) if q_from or q_to else "entries"
+    except ValueError as e:
+        flash(f"{e} Showing open years only.", "warning"); source = "entries"
+    before = page_cursor(request.args.get("before")); after = page_cursor(request.args.get("after"))
+    order = "DESC"
+    if before:
+        clauses.append("(e.entry_date, e.id) < (?, ?)"); params += before
+    elif after:
+        clauses.append("(e.entry_date, e.id) > (?, ?)"); params += after; order = "ASC"
+    cur.execute(ENTRY_LIST_SQL.format(entries=source, where=where_sql(clauses), order=order), params + [ENTRY_PAGE_SIZE + 1])
+    entries = cur.fetchall()
+    more = len(entries) > ENTRY_PAGE_SIZE; entries = entries[:ENTRY_PAGE_SIZE]
+    if after: entries.reverse()
+    has_next, has_prev = (True, more) if after else (more, bool(before))
+    next_cursor = cursor_of(entries[-1]) if entries and has_next else None
+    prev_cursor = cursor_of(entries[0]) if entries and has_prev else None
+    if request.args.get("partial"):
+        # Page fetches from the list only need the rows, not the form dropdowns.
+        return render_template("entry_rows.html", entries=entries, next_cursor=next_cursor, prev_cursor=prev_cursor)
+    trucks, drivers = ref_lists(conn)
+    return render_template("expense_income.html", title=APP_TITLE, trucks=trucks, drivers=drivers, entries=entries,
+                           next_cursor=next_cursor, prev_cursor=prev_cursor)
 
 @app.route("/entry/<int:id>/delete", methods=["POST"])
 def delete_entry(id):
@@ -220,61 +1321,483 @@ def delete_entry(id):
         flash('Wrong deletion password.', 'warning')
         return redirect(url_for('expense_income'))
     conn = get_db()
+    if (year := archived_entry(conn, id)):
+        flash(f"{year} is archived and closed to changes.", "warning")
+        return redirect(url_for("expense_income"))
+    rollup_entry(conn, id, -1)
     conn.execute("DELETE FROM entries WHERE id=?", (id,))
     conn.commit()
-    conn.close()
     flash("Entry deleted.", "info")
     return redirect(url_for("expense_income"))
 
 @app.route("/entry/<int:id>/edit", methods=["GET","POST"])
 def edit_entry(id):
-    conn = get_db(); cur = conn.cursor()
+    conn = get_db(readonly=request.method == "GET"); cur = conn.cursor()
+    if (year := archived_entry(conn, id)):
+        flash(f"{year} is archived and closed to changes.", "warning")
+        return redirect(url_for("expense_income"))
     if request.method == "POST":
-        entry_date = request.form.get("entry_date")
-        is_income = int(request.form.get("is_income"))
-        category = request.form.get("category")
-        amount = float(request.form.get("amount") or 0)
-        hst_included = int(request.form.get("hst_included"))
-        description = request.form.get("description") or ""
-        truck_id = request.form.get("truck_id") or None
-        driver_id = request.form.get("driver_id") or None
-        if category.lower().strip() == "driver income":
-            category = "Driver Pay"
-        errors = []
-        if not entry_date: errors.append("Date is required")
-        if not amount or amount <= 0: errors.append("Amount must be greater than 0")
-        if not truck_id: errors.append("Truck is required")
-        if not driver_id: errors.append("Driver is required")
-        if not description.strip(): errors.append("Description is required")
+        row, errors = clean_entry(request.form.to_dict(), archived_years(conn))
         if errors:
             for e in errors: flash(e, "warning")
-            conn.close(); return redirect(url_for("edit_entry", id=id))
-        cur.execute("""UPDATE entries SET entry_date=?, is_income=?, category=?, amount=?, hst_included=?, description=?, truck_id=?, driver_id=? WHERE id=?""",
-                    (entry_date, is_income, category, amount, hst_included, description, truck_id, driver_id, id))
-        conn.commit(); conn.close()
+            return redirect(url_for("edit_entry", id=id))
+        rollup_entry(cur, id, -1)
+        cur.execute(f"UPDATE entries SET {', '.join(k+'=?' for k in ENTRY_FIELDS)} WHERE id=?", (*row, id))
+        rollup_entry(cur, id, 1)
+        conn.commit()
         flash("Entry updated.", "success")
         return redirect(url_for("expense_income"))
-    cur.execute("SELECT * FROM entries WHERE id=?", (id,)); entry = cur.fetchone()
-    cur.execute("SELECT * FROM trucks ORDER BY name"); trucks = cur.fetchall()
-    cur.execute("SELECT * FROM drivers ORDER BY name"); drivers = cur.fetchall()
-    conn.close()
+    cur.execute("SELECT *, amount_cents/100.0 AS amount FROM entries WHERE id=?", (id,)); entry = cur.fetchone()
+    trucks, drivers = ref_lists(conn)
     return render_template("edit_entry.html", title=APP_TITLE, entry=entry, trucks=trucks, drivers=drivers)
 
+# ---------- Search ----------
+# Every word typed must match description or category as a prefix ("tir" finds "Tires"); the ledger
+# filters (dates, truck, driver, category, type, amount) narrow the matches. Pages are numbered since
+# results are ordered by relevance.
+SEARCH_PAGE_SIZE = 50
+
+def fts_query(text):
+    # Each word quoted, so FTS5 operators and punctuation in the box are taken literally.
+    return " ".join(f'"{w}"*' for w in re.findall(r"\w+", text or ""))
+
+@app.route("/search")
+def search():
+    conn = get_db(readonly=True)
+    if (cached := not_modified(data_version(conn))): return cached
+    q = (request.args.get("q") or "").strip()
+    try:
+        page = max(1, int(request.args.get("page") or 1))
+    except ValueError:
+        page = 1
+    entries = []; more = False
+    if fts_query(q):
+        clauses, params = entry_filters(request.args)
+        sql = SEARCH_SQL.format(filters="".join(" AND " + c for c in clauses))
+        entries = conn.execute(sql, [fts_query(q), *params, SEARCH_PAGE_SIZE + 1, (page-1) * SEARCH_PAGE_SIZE]).fetchall()
+        more = len(entries) > SEARCH_PAGE_SIZE; entries = entries[:SEARCH_PAGE_SIZE]
+    trucks, drivers = ref_lists(conn)
+    return render_template("search.html", title=APP_TITLE, q=q, entries=entries, trucks=trucks, drivers=drivers,
+                           page=page, next_page=page+1 if more else None, prev_page=page-1 if page > 1 else None)
+
+# ---------- Bulk import (CSV / JSONL) ----------
+# Rows go through the same clean_entry() as the form and are inserted IMPORT_BATCH at a time, one
+# transaction per batch so other workers can still write between batches. Rejected rows are written
+# to a CSV under REPORTS_DIR/imports with their line number and reasons, served (behind the login) by
+# /import_rejects/<name>.
+IMPORT_BATCH = 10000
+HST_VALUES = {"with": 1, "1": 1, "yes": 1, "true": 1, "without": 0, "0": 0, "no": 0, "false": 0}
+
+def read_import(stream, fmt):
+    # Yields (line number, record dict or raw text, parse error or None) from a binary stream.
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    if fmt == "jsonl":
+        for n, line in enumerate(text, 1):
+            if not line.strip(): continue
+            try:
+                rec = json.loads(line)
+            except ValueError as e:
+                yield n, line.rstrip("\r\n"), f"Invalid JSON: {e}"; continue
+            yield n, rec, None if isinstance(rec, dict) else "Expected a JSON object"
+    else:
+        reader = csv.DictReader(text)
+        for rec in reader:
+            yield reader.line_num, rec, None
+
+def name_map(cur, table):
+    # (lower-cased name -> [(name, id)], str(id) -> id), kept apart so a truck named "2" and truck id 2
+    # can't shadow each other. Names are unique only case-sensitively, so a lookup can match several.
+    names, ids = {}, {}
+    for r in cur.execute(f"SELECT id, name FROM {table}"):
+        names.setdefault(r["name"].strip().lower(), []).append((r["name"].strip(), r["id"])); ids[str(r["id"])] = r["id"]
+    return names, ids
+
+def lookup_ref(refs, kind, value, id_value):
+    # "truck"/"driver" are resolved by name, falling back to an id only when no name matches;
+    # "truck_id"/"driver_id" only by id. Returns (id, error).
+    names, ids = refs
+    if value not in (None, ""):
+        value = str(value).strip(); found = names.get(value.lower(), [])
+        found = [i for n, i in found if n == value] or [i for n, i in found]
+        if len(found) > 1: return None, f"{kind.capitalize()} '{value}' matches more than one {kind}"
+        if not found and value in ids: found = [ids[value]]
+        return (found[0], None) if found else (None, f"Unknown {kind} '{value}'")
+    if id_value not in (None, ""):
+        found = ids.get(str(id_value).strip())
+        return (found, None) if found else (None, f"Unknown {kind}_id '{id_value}'")
+    return None, None
+
+def import_fields(rec, trucks, drivers):
+    # Maps an import record onto clean_entry() fields the way the expense_income form does.
+    rec = {str(k).strip().lower(): (v.strip() if isinstance(v, str) else v) for k, v in rec.items() if k is not None}
+    errors = []
+    kind = str(rec.get("type") or "").lower()
+    if kind in ("income", "expense"):
+        is_income = 1 if kind == "income" else 0
+    else:
+        if kind: errors.append(f"Unknown type '{kind}'")
+        is_income = 1 if str(rec.get("is_income") or "0").lower() in ("1", "true", "yes") else 0
+    hst = str(rec.get("hst_included", rec.get("hst")) or "with").lower()
+    if hst not in HST_VALUES: errors.append(f"Unknown HST option '{hst}'")
+    ids = {}
+    for name, refs in (("truck", trucks), ("driver", drivers)):
+        ids[name], error = lookup_ref(refs, name, rec.get(name), rec.get(f"{name}_id"))
+        if error: errors.append(error)
+    fields = {
+        "entry_date": rec.get("entry_date") or rec.get("date"), "amount": rec.get("amount"),
+        "description": rec.get("description"), "truck_id": ids["truck"], "driver_id": ids["driver"],
+        "is_income": is_income, "category": "Income" if is_income else rec.get("category"),
+        "hst_included": 1 if is_income else HST_VALUES.get(hst, 1),
+    }
+    return fields, errors
+
+def flush_import(conn, batch):
+    if not batch: return 0
+    cur = conn.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    after_id = cur.execute("SELECT IFNULL(MAX(id), 0) FROM entries").fetchone()[0]
+    cur.execute("INSERT INTO bulk_insert VALUES (1)")
+    cur.executemany(INSERT_ENTRY_SQL, batch)
+    cur.execute("DELETE FROM bulk_insert")
+    cur.execute("INSERT INTO entries_fts(rowid, description, category) SELECT id, description, category FROM entries WHERE id>?", (after_id,))
+    cur.execute(LOG_INSERTED_SQL, (after_id,))
+    rollup_since(cur, after_id)
+    conn.commit()
+    return len(batch)
+
+def import_entries(conn, records):
+    # Returns (inserted, rejected, path of the reject file or None).
+    cur = conn.cursor()
+    trucks = name_map(cur, "trucks"); drivers = name_map(cur, "drivers"); closed = archived_years(conn)
+    inserted = rejected = 0; batch = []; reject_path = None; reject_file = None
+    try:
+        for line, rec, error in records:
+            errors = [error] if error else []
+            if not errors:
+                try:
+                    fields, errors = import_fields(rec, trucks, drivers)
+                    row, more = clean_entry(fields, closed)
+                    errors += more
+                except (TypeError, ValueError, AttributeError) as e:
+                    # A malformed record is one more reject, not the end of an import whose earlier batches are committed.
+                    errors = [f"Invalid record: {e}"]
+            if errors:
+                if reject_file is None:
+                    reject_path = os.path.join(REPORTS_DIR, "imports", f"rejects_{datetime.now():%Y%m%d_%H%M%S}_{uuid.uuid4().hex[:6]}.csv")
+                    os.makedirs(os.path.dirname(reject_path), exist_ok=True)
+                    reject_file = open(reject_path, "w", newline="", encoding="utf-8")
+                    rejects = csv.writer(reject_file); rejects.writerow(["line", "errors", "record"])
+                rejects.writerow([line, "; ".join(errors), json.dumps(rec) if isinstance(rec, dict) else rec])
+                rejected += 1
+                continue
+            batch.append(row)
+            if len(batch) >= IMPORT_BATCH:
+                inserted += flush_import(conn, batch); batch = []
+        inserted += flush_import(conn, batch)
+    finally:
+        if reject_file is not None: reject_file.close()
+    prune_change_log(conn)
+    return inserted, rejected, reject_path
+
+def import_format(filename, fmt=None):
+    if fmt in ("csv", "jsonl"): return fmt
+    return "jsonl" if (filename or "").lower().endswith((".jsonl", ".ndjson", ".json")) else "csv"
+
+@app.route("/import_entries", methods=["GET","POST"])
+def import_entries_page():
+    result = None
+    if request.method == "POST":
+        upload = request.files.get("file")
+        if not upload or not upload.filename:
+            flash("Choose a CSV or JSONL file to import.", "warning")
+            return redirect(url_for("import_entries_page"))
+        fmt = import_format(upload.filename, request.form.get("format"))
+        inserted, rejected, reject_path = import_entries(get_db(), read_import(upload.stream, fmt))
+        result = {"inserted": inserted, "rejected": rejected,
+                  "reject_url": url_for("import_rejects", name=os.path.basename(reject_path)) if reject_path else None}
+        flash(f"Imported {inserted} entries, rejected {rejected}.", "success" if not rejected else "warning")
+    return render_template("import_entries.html", title=APP_TITLE, result=result)
+
+@app.route("/import_rejects/<name>")
+def import_rejects(name):
+    path = os.path.join(REPORTS_DIR, "imports", secure_filename(name))
+    if not name.endswith(".csv") or not os.path.isfile(path):
+        flash("Reject file not found.", "warning")
+        return redirect(url_for("import_entries_page"))
+    return send_file(path, as_attachment=True, download_name=os.path.basename(path))
+
+@app.cli.command("import-entries")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "fmt", type=click.Choice(["csv", "jsonl"]), help="Defaults to the file extension.")
+def import_entries_command(path, fmt):
+    """Bulk import entries from a CSV or JSONL file."""
+    started = time.perf_counter()
+    with open(path, "rb") as f:
+        inserted, rejected, reject_path = import_entries(get_db(), read_import(f, import_format(path, fmt)))
+    elapsed = time.perf_counter() - started
+    click.echo(f"imported {inserted} entries, rejected {rejected} in {elapsed:.1f}s ({inserted/max(elapsed, 1e-9):,.0f} rows/s)")
+    if reject_path: click.echo(f"rejected rows: {reject_path}")
+
+# ---------- Synthetic data (benchmarks) ----------
+# Seeded, so the same options on an empty database always produce the same ledger. Per entry: a quarter
+# are income loads, a sixth Driver Pay, the rest weighted expense categories, across both HST options.
+SEED_FIRST = ("Amrit", "Baljit", "Gurpreet", "Harjit", "Jaspal", "Kulwant", "Manpreet", "Navdeep", "Paramjit", "Ranjit",
+              "Sandeep", "Tejinder", "Mike", "Dave", "Chris", "Steve", "Tom", "Paul", "Mark", "John")
+SEED_LAST = ("Singh", "Dhillon", "Sandhu", "Gill", "Brar", "Sidhu", "Grewal", "Smith", "Brown", "Wilson", "Taylor", "Martin")
+SEED_EXPENSES = (  # (category, weight, min $, max $, share entered with HST)
+    ("Fuel", 40, 150, 1400, 0.9), ("Repairs", 12, 200, 9000, 0.8), ("Maintenance", 15, 80, 2500, 0.8),
+    ("Tolls", 12, 10, 180, 0.5), ("Insurance", 6, 900, 4500, 0.2), ("Other", 15, 20, 800, 0.6),
+)
+
+def seed_rows(rng, count, truck_ids, driver_ids, days):
+    categories = [e for e in SEED_EXPENSES for _ in range(e[1])]
+    for n in range(count):
+        day = rng.choice(days); truck = rng.choice(truck_ids); driver = rng.choice(driver_ids)
+        kind = rng.random()
+        if kind < 0.25:
+            yield (day, 1, "Income", rng.randrange(80000, 650000), 1, f"Load #{n+1000}", truck, driver)
+        elif kind < 0.42:
+            yield (day, 0, "Driver Pay", rng.randrange(60000, 320000), rng.random() < 0.5, "Weekly pay", truck, driver)
+        else:
+            category, _, low, high, with_hst = rng.choice(categories)
+            yield (day, 0, category, rng.randrange(low*100, high*100), rng.random() < with_hst, category, truck, driver)
+
+def seed_database(conn, entries, trucks, drivers, years, seed=1):
+    # Adds trucks/drivers as needed and `entries` entries over the last `years` years; returns the entry count.
+    rng = random.Random(seed)
+    cur = conn.cursor()
+    cur.executemany("INSERT OR IGNORE INTO trucks(name) VALUES (?)", [(f"Truck {101+i}",) for i in range(trucks)])
+    names = [f"{f} {l}" for l in SEED_LAST for f in SEED_FIRST]
+    cur.executemany("INSERT OR IGNORE INTO drivers(name) VALUES (?)",
+                    [(names[i % len(names)] + (f" {i//len(names)+1}" if i >= len(names) else ""),) for i in range(drivers)])
+    bump_version(conn, "ref"); conn.commit()
+    truck_ids = [r[0] for r in cur.execute("SELECT id FROM trucks ORDER BY id LIMIT ?", (trucks,))]
+    driver_ids = [r[0] for r in cur.execute("SELECT id FROM drivers ORDER BY id LIMIT ?", (drivers,))]
+    today = date.today(); first = today.replace(year=today.year - years, day=1)
+    days = [(first + timedelta(days=i)).isoformat() for i in range((today - first).days + 1)]
+    rows = seed_rows(rng, entries, truck_ids, driver_ids, days)
+    inserted = 0
+    while batch := list(itertools.islice(rows, IMPORT_BATCH)):
+        inserted += flush_import(conn, batch)
+    return inserted
+
+@app.cli.command("seed")
+@click.option("--entries", default=100000, show_default=True)
+@click.option("--trucks", default=50, show_default=True)
+@click.option("--drivers", default=100, show_default=True)
+@click.option("--years", default=5, show_default=True)
+@click.option("--seed", "seed_value", default=1, show_default=True, help="Random seed.")
+@click.option("--append", is_flag=True, help="Allow adding to a database that already has entries.")
+def seed_command(entries, trucks, drivers, years, seed_value, append):
+    """Fill the database with synthetic trucks, drivers and entries (set DD_DB_PATH to use a scratch file)."""
+    db = get_db()
+    if not append and db.execute("SELECT 1 FROM entries LIMIT 1").fetchone():
+        raise SystemExit(f"{DB_PATH} already has entries; pass --append to add to it anyway")
+    started = time.perf_counter()
+    inserted = seed_database(db, entries, trucks, drivers, years, seed_value)
+    elapsed = time.perf_counter() - started
+    click.echo(f"seeded {inserted} entries in {elapsed:.1f}s ({inserted/max(elapsed, 1e-9):,.0f} rows/s) into {DB_PATH}")
+
+# ---------- Ledger export (CSV / XLSX) ----------
+# Rows are read with fetchmany and written out batch by batch, so the first bytes leave at once and
+# memory stays flat however long the ledger is.
+EXPORT_BATCH = 2000
+EXPORT_COLUMNS = ["ID", "Date", "Type", "Category", "Amount", "HST Included", "Amount incl. HST", "Description", "Truck", "Driver"]
+# Money columns come out of EXPORT_SQL as exact two-decimal text; the XLSX writes them as numbers shown as 0.00.
+EXPORT_MONEY = (EXPORT_COLUMNS.index("Amount"), EXPORT_COLUMNS.index("Amount incl. HST"))
+EXPORT_SQL = f"""
+    SELECT e.id, e.entry_date, CASE WHEN e.is_income=1 THEN 'Income' ELSE 'Expense' END, e.category, printf('%.2f', e.amount_cents/100.0),
+           CASE WHEN e.hst_included=1 THEN 'Yes' ELSE 'No' END, printf('%.2f', ({GROSS_CENTS.format(e='e.')})/100.0),
+           e.description, t.name, d.name {ENTRY_JOIN}
+    {{where}}
+    ORDER BY e.entry_date ASC, e.id ASC
+"""
+XLSX_MAX_ROWS = 1048575
+XML_ILLEGAL = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+def entry_filters(args):
+    # WHERE clauses and params for the ledger filters (from/to, truck, driver, category, income/expense,
+    # min/max amount as entered).
+    clauses = []; params = []
+    q_from = iso_date(args.get("from")); q_to = iso_date(args.get("to"))
+    if q_from: clauses.append("e.entry_date>=?"); params.append(q_from)
+    if q_to: clauses.append("e.entry_date<=?"); params.append(q_to)
+    for key in ("truck_id", "driver_id", "category"):
+        if args.get(key): clauses.append(f"e.{key}=?"); params.append(args.get(key))
+    if args.get("type") in ("income", "expense"):
+        clauses.append("e.is_income=?"); params.append(1 if args.get("type") == "income" else 0)
+    for key, op in (("min_amount", ">="), ("max_amount", "<=")):
+        cents = to_cents(args.get(key)) if args.get(key) else 0
+        if cents: clauses.append(f"e.amount_cents{op}?"); params.append(cents)
+    return clauses, params
+
+def where_sql(clauses):
+    return ("WHERE " + " AND ".join(clauses)) if clauses else ""
+
+def fetch_batches(cur):
+    while True:
+        rows = cur.fetchmany(EXPORT_BATCH)
+        if not rows: return
+        yield rows
+
+def export_csv(cur):
+    buf = io.StringIO(); out = csv.writer(buf)
+    out.writerow(EXPORT_COLUMNS)
+    yield buf.getvalue()
+    for rows in fetch_batches(cur):
+        buf.seek(0); buf.truncate()
+        out.writerows(rows)
+        yield buf.getvalue()
+
+class StreamSink:
+    # Write-only file object for zipfile that hands the written bytes back to a generator.
+    def __init__(self): self.chunks = []
+    def write(self, data): self.chunks.append(bytes(data)); return len(data)
+    def flush(self): pass
+    def drain(self):
+        data = b"".join(self.chunks); self.chunks.clear(); return data
+
+def stream_zip(files):
+    # files: iterable of (name, iterable of bytes); yields the archive as each member is written.
+    sink = StreamSink()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name, chunks in files:
+            with zf.open(name, "w", force_zip64=True) as member:
+                for chunk in chunks:
+                    member.write(chunk)
+                    if sink.chunks: yield sink.drain()
+            yield sink.drain()
+    yield sink.drain()
+
+def xlsx_cell(value):
+    if isinstance(value, (int, float)):
+        return f"<c><v>{value}</v></c>"
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{escape(XML_ILLEGAL.sub("", str(value or "")))}</t></is></c>'
+
+def xlsx_row(values, money=()):
+    return "<row>" + "".join(f'<c s="1"><v>{v}</v></c>' if i in money and v is not None else xlsx_cell(v)
+                             for i, v in enumerate(values)) + "</row>"
+
+def export_xlsx(cur):
+    # Minimal SpreadsheetML package; a new sheet starts every XLSX_MAX_ROWS rows.
+    batches = fetch_batches(cur); pending = []; sheets = []
+
+    def sheet():
+        head = '<?xml version="1.0" encoding="UTF-8"?><worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+        yield (head + xlsx_row(EXPORT_COLUMNS)).encode()
+        written = 0
+        while written < XLSX_MAX_ROWS:
+            rows = pending.pop() if pending else next(batches, None)
+            if rows is None: break
+            take = rows[:XLSX_MAX_ROWS - written]
+            if len(take) < len(rows): pending.append(rows[len(take):])
+            yield "".join(xlsx_row(r, EXPORT_MONEY) for r in take).encode()
+            written += len(take)
+        yield b"</sheetData></worksheet>"
+
+    def sheets_then_workbook():
+        while True:
+            sheets.append(f"Ledger {len(sheets)+1}" if sheets else "Ledger")
+            yield f"xl/worksheets/sheet{len(sheets)}.xml", sheet()
+            if not pending:
+                more = next(batches, None)
+                if more is None: break
+                pending.append(more)
+        n = range(1, len(sheets)+1)
+        yield "[Content_Types].xml", [(
+            '<?xml version="1.0" encoding="UTF-8"?><Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            '<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+            + "".join(f'<Override PartName="/xl/worksheets/sheet{i}.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>' for i in n)
+            + "</Types>").encode()]
+        yield "_rels/.rels", [(
+            '<?xml version="1.0" encoding="UTF-8"?><Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+            "</Relationships>").encode()]
+        yield "xl/workbook.xml", [(
+            '<?xml version="1.0" encoding="UTF-8"?><workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships"><sheets>'
+            + "".join(f'<sheet name="{escape(sheets[i-1])}" sheetId="{i}" r:id="rId{i}"/>' for i in n)
+            + "</sheets></workbook>").encode()]
+        # Style 1 is the built-in "0.00" number format, for the money cells.
+        yield "xl/styles.xml", [(
+            '<?xml version="1.0" encoding="UTF-8"?><styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+            '<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>'
+            '<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>'
+            '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+            '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+            '<cellXfs count="2"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+            '<xf numFmtId="2" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/></cellXfs>'
+            '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles></styleSheet>').encode()]
+        yield "xl/_rels/workbook.xml.rels", [(
+            '<?xml version="1.0" encoding="UTF-8"?><Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            + "".join(f'<Relationship Id="rId{i}" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet{i}.xml"/>' for i in n)
+            + '<Relationship Id="rIdStyles" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+            + "</Relationships>").encode()]
+
+    return stream_zip(sheets_then_workbook())
+
+class ChainedCursor:
+    # fetchmany() across cursors taken one at a time from an iterator, each once the last is used up.
+    def __init__(self, cursors):
+        self.cursors = iter(cursors); self.cur = next(self.cursors, None)
+
+    def fetchmany(self, size):
+        while self.cur is not None:
+            rows = self.cur.fetchmany(size)
+            if rows: return rows
+            self.cur = next(self.cursors, None)
+        return []
+
+def export_stream(clauses, params, date_range, writer):
+    # Owns its connection: the response body is consumed after the request's teardown has closed get_db().
+    conn = connect_db(readonly=True)
+    def parts():
+        spans = ledger_spans(conn, *date_range)
+        for n, (lo, hi) in enumerate(spans):
+            span = [] if len(spans) == 1 else [(c, v) for c, v in (("e.entry_date>=?", lo), ("e.entry_date<=?", hi)) if v]
+            if n: detach_archives(conn)
+            sql = EXPORT_SQL.format(entries=ledger_source(conn, lo, hi), where=where_sql(clauses + [c for c, v in span]))
+            yield conn.execute(sql, params + [v for c, v in span])
+    try:
+        yield from writer(ChainedCursor(parts()))
+    finally:
+        conn.close()
+
+@app.route("/export")
+def export_entries():
+    fmt = request.args.get("format", "csv")
+    if fmt not in ("csv", "xlsx"):
+        flash("Export format must be csv or xlsx.", "warning")
+        return redirect(url_for("expense_income"))
+    clauses, params = entry_filters(request.args)
+    filename = f"DD_Ledger_{date.today().isoformat()}.{fmt}"
+    if fmt == "csv":
+        writer, mimetype = export_csv, "text/csv"
+    else:
+        writer, mimetype = export_xlsx, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    date_range = (iso_date(request.args.get("from")), iso_date(request.args.get("to")))
+    body = export_stream(clauses, params, date_range, writer)
+    return Response(body, mimetype=mimetype,
+                    headers={"Content-Disposition": f"attachment; filename={filename}"})
+
 # ---------- Trucks ----------
 @app.route("/trucks", methods=["GET","POST"])
 def trucks():
-    conn = get_db(); cur = conn.cursor()
+    conn = get_db(readonly=request.method == "GET"); cur = conn.cursor()
     if request.method == "POST":
         name = request.form.get("name")
         if name:
             try:
-                cur.execute("INSERT INTO trucks(name) VALUES(?)", (name,)); conn.commit()
+                cur.execute("INSERT INTO trucks(name) VALUES(?)", (name,)); bump_version(conn, "ref"); conn.commit()
                 flash("Truck added.", "success")
             except sqlite3.IntegrityError:
                 flash("Truck already exists.", "warning")
         return redirect(url_for("trucks"))
-    cur.execute("SELECT * FROM trucks ORDER BY name"); items = cur.fetchall(); conn.close()
-    return render_template("trucks.html", title=APP_TITLE, items=items)
+    if (cached := not_modified(data_version(conn, "ref"))): return cached
+    return render_template("trucks.html", title=APP_TITLE, items=ref_lists(conn)[0])
 
 @app.route("/trucks/<int:id>/delete", methods=["POST"])
 def delete_truck(id):
@@ -282,32 +1805,32 @@ def delete_truck(id):
     if pwd != DELETE_PASSWORD:
         flash('Wrong deletion password.', 'warning')
         return redirect(url_for('trucks'))
-    conn = get_db(); conn.execute("DELETE FROM trucks WHERE id=?", (id,)); conn.commit(); conn.close()
+    conn = get_db(); conn.execute("DELETE FROM trucks WHERE id=?", (id,)); bump_version(conn, "ref"); conn.commit()
     flash("Truck deleted.", "info")
     return redirect(url_for("trucks"))
 
 @app.route("/trucks/<int:id>/edit", methods=["POST"])
 def edit_truck(id):
     name = request.form.get("name")
-    conn = get_db(); conn.execute("UPDATE trucks SET name=? WHERE id=?", (name, id)); conn.commit(); conn.close()
+    conn = get_db(); conn.execute("UPDATE trucks SET name=? WHERE id=?", (name, id)); bump_version(conn, "ref"); conn.commit()
     flash("Truck updated.", "success")
     return redirect(url_for("trucks"))
 
 # ---------- Drivers ----------
 @app.route("/drivers", methods=["GET","POST"])
 def drivers():
-    conn = get_db(); cur = conn.cursor()
+    conn = get_db(readonly=request.method == "GET"); cur = conn.cursor()
     if request.method == "POST":
         name = request.form.get("name")
         if name:
             try:
-                cur.execute("INSERT INTO drivers(name) VALUES(?)", (name,)); conn.commit()
+                cur.execute("INSERT INTO drivers(name) VALUES(?)", (name,)); bump_version(conn, "ref"); conn.commit()
                 flash("Driver added.", "success")
             except sqlite3.IntegrityError:
                 flash("Driver already exists.", "warning")
         return redirect(url_for("drivers"))
-    cur.execute("SELECT * FROM drivers ORDER BY name"); items = cur.fetchall(); conn.close()
-    return render_template("drivers.html", title=APP_TITLE, items=items)
+    if (cached := not_modified(data_version(conn, "ref"))): return cached
+    return render_template("drivers.html", title=APP_TITLE, items=ref_lists(conn)[1])
 
 @app.route("/drivers/<int:id>/delete", methods=["POST"])
 def delete_driver(id):
@@ -315,7 +1838,7 @@ def delete_driver(id):
     if pwd != DELETE_PASSWORD:
         flash('Wrong deletion password.', 'warning')
         return redirect(url_for('drivers'))
-    conn = get_db(); conn.execute("DELETE FROM drivers WHERE id=?", (id,)); conn.commit(); conn.close()
+    conn = get_db(); conn.execute("DELETE FROM drivers WHERE id=?", (id,)); bump_version(conn, "ref"); conn.commit()
     flash("Driver deleted.", "info")
     return redirect(url_for("drivers"))
 
@@ -324,201 +1847,996 @@ def edit_driver(id):
     name = request.form.get("name")
     conn = get_db()
     conn.execute("UPDATE drivers SET name=? WHERE id=?", (name, id))
+    bump_version(conn, "ref")
     conn.commit()
-    conn.close()
     flash("Driver updated.", "success")
     return redirect(url_for("drivers"))
 
+# ---------- Report cache ----------
+# Generated PDFs are named <prefix>_<params hash>_<data hash>.pdf, where the data hash covers the
+# data_versions stamp of every month the report reads. A write to any of those months changes the
+# stamp, so the next request renders a fresh file and drops the stale one; mtime doubles as LRU order.
+REPORT_CACHE_MAX_BYTES = 200 * 1024 * 1024
+CACHE_SUFFIX = re.compile(r"_[0-9a-f]{12}_[0-9a-f]{12}\.pdf$")
+
+def month_after(day):
+    return date(day.year + (1 if day.month==12 else 0), 1 if day.month==12 else day.month+1, 1)
+
+def data_stamp(conn, month_from, month_to):
+    # month_from inclusive, month_to exclusive, both 'YYYY-MM'
+    rows = conn.execute("SELECT scope, version FROM data_versions WHERE (scope>=? AND scope<?) OR scope='ref' ORDER BY scope",
+                        (month_from, month_to)).fetchall()
+    return ",".join(f"{r['scope']}:{r['version']}" for r in rows)
+
+def cached_report(prefix, params, stamp, build):
+    # build(path) renders the PDF and returns False when there is nothing to report. The render date is part
+    # of the key because header_pdf() prints it: a PDF cached yesterday is rebuilt rather than served again.
+    prefix = secure_filename(prefix)
+    pkey = hashlib.sha256(repr(params).encode()).hexdigest()[:12]
+    dkey = hashlib.sha256(f"{params!r}|{stamp}|{date.today()}".encode()).hexdigest()[:12]
+    path = os.path.join(REPORTS_DIR, f"{prefix}_{pkey}_{dkey}.pdf")
+    if os.path.exists(path):
+        os.utime(path)
+        return path
+    os.makedirs(REPORTS_DIR, exist_ok=True)
+    tmp = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    try:
+        if not build(tmp):
+            return None
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp): os.remove(tmp)
+    for old in glob.glob(os.path.join(REPORTS_DIR, f"{glob.escape(prefix)}_{pkey}_*.pdf")):
+        if old != path:
+            try: os.remove(old)
+            except OSError: pass
+    evict_reports(keep=path)
+    return path
+
+def evict_reports(keep=None, max_bytes=REPORT_CACHE_MAX_BYTES):
+    files = []
+    for name in os.listdir(REPORTS_DIR):
+        p = os.path.join(REPORTS_DIR, name)
+        if name.endswith(".pdf") and os.path.isfile(p):
+            st = os.stat(p); files.append((st.st_mtime, st.st_size, p))
+    total = sum(f[1] for f in files)
+    for mtime, size, p in sorted(files):
+        if total <= max_bytes: break
+        if p == keep: continue
+        try: os.remove(p); total -= size
+        except OSError: pass
+
 # ---------- Monthly Reports ----------
+MONTHLY_COLUMNS = [
+    ("Date", 0.8, "left", lambda r: r["entry_date"]),
+    ("Type", 1.6, "left", lambda r: "Income" if r["is_income"]==1 else "Expense"),
+    ("Category", 2.5, "left", lambda r: r["category"] or "-"),
+    ("Driver", 4.0, "left", lambda r: r["driver_name"] or "-"),
+    ("Amount", 7.7, "right", lambda r: fmt_cents(r["gross_cents"])),
+]
+
+def total_lines(income, expense, profit):
+    return [("Total Income:", income, False), ("Total Expenses:", expense, False), ("Profit/Loss:", profit, True)]
+
+def render_monthly_report(out, start, rows, by_truck, truck_name=None):
+    # truck_name=None draws the all-trucks layout: a section per truck (rows ordered by truck) plus a summary page.
+    # by_truck is truck_totals() for the trucks in the report. out is a path or a binary file object.
+    inc, exp, prof = sum_totals(by_truck.values())
+    with pdf_canvas(out, "monthly") as c:
+        if truck_name is not None:
+            title = f"Monthly Report: {start.strftime('%B %Y')} — {truck_name}"
+            y = draw_table(c, title, MONTHLY_COLUMNS, rows)
+            draw_totals(c, title, y, total_lines(inc, exp, prof))
+            c.showPage()
+            return
+
+        for (tid, tname), items in itertools.groupby(rows, key=lambda r: (r["truck_id"], r["truck_name"] or "—")):
+            title = f"Monthly Report: {start.strftime('%B %Y')} — {tname}"
+            y = draw_table(c, title, MONTHLY_COLUMNS, items)
+            draw_totals(c, title, y, total_lines(*by_truck.get(tid or 0, (0, 0, 0))))
+            c.showPage()
+
+        title = f"Monthly Summary: {start.strftime('%B %Y')} — All Trucks"
+        header_pdf(c, title)
+        draw_totals(c, title, TABLE_TOP + 0.1*inch, total_lines(inc, exp, prof))
+        c.showPage()
+
+def build_monthly_report(cur, pdf_full, start, end, truck_id):
+    by_truck = truck_totals(cur, start.strftime('%Y-%m'), end.strftime('%Y-%m'))
+    source = ledger_source(cur.connection, str(start), str(start))
+    if truck_id == "all":
+        first, rows = peek_rows(cur.execute(MONTHLY_ALL_SQL.format(entries=source), (str(start), str(end))))
+        if first is None:
+            return False
+        render_monthly_report(pdf_full, start, rows, by_truck)
+        return True
+
+    first, rows = peek_rows(cur.execute(MONTHLY_TRUCK_SQL.format(entries=source), (str(start), str(end), truck_id)))
+    if first is None:
+        return False
+    render_monthly_report(pdf_full, start, rows, {first["truck_id"]: by_truck.get(first["truck_id"], (0, 0, 0))}, first["truck_name"])
+    return True
+
+def monthly_report_pdf(conn, truck_id, year, month):
+    # Cached or freshly built PDF path, or None when there is nothing to report.
+    start = date(year, month, 1)
+    end = month_after(start)
+    if truck_id == "all":
+        prefix = f"Monthly_Report_{start.strftime('%Y_%m')}_All_Trucks"
+    else:
+        rw = conn.execute("SELECT name FROM trucks WHERE id=?", (truck_id,)).fetchone()
+        prefix = f"Monthly_Report_{start.strftime('%Y_%m')}_Truck_{rw['name'] if rw else truck_id}"
+    stamp = data_stamp(conn, start.strftime('%Y-%m'), end.strftime('%Y-%m'))
+    return cached_report(prefix, ("monthly", truck_id, str(start)), stamp,
+                         lambda out: build_monthly_report(conn.cursor(), out, start, end, truck_id))
+
 @app.route("/monthly_reports", methods=["GET","POST"])
 def monthly_reports():
-    conn = get_db(); cur = conn.cursor()
-    cur.execute("SELECT * FROM trucks ORDER BY name"); trucks = cur.fetchall()
-    pdf_path = None
+    conn = get_db(readonly=True)
+    if request.method == "GET" and (cached := not_modified(data_version(conn, "ref"))): return cached
+    trucks = ref_lists(conn)[0]
+    pdf_path = None; job_id = None
     if request.method == "POST":
         truck_id = request.form.get("truck_id")
         month = int(request.form.get("month")); year = int(request.form.get("year"))
-        start = date(year, month, 1)
-        end = date(year + (1 if month==12 else 0), 1 if month==12 else month+1, 1)
-
-        if truck_id == "all":
-            cur.execute("""
-                SELECT e.*, t.id AS truck_id, t.name AS truck_name, d.name AS driver_name
-                FROM entries e
-                LEFT JOIN trucks t ON e.truck_id = t.id
-                LEFT JOIN drivers d ON e.driver_id = d.id
-                WHERE date(entry_date)>=? AND date(entry_date)<?
-                ORDER BY t.name ASC, date(entry_date) ASC, e.id ASC
-            """, (str(start), str(end)))
-            rows = cur.fetchall()
-            if not rows:
-                flash("No data available for the selected month.", "warning")
-                conn.close()
-                return render_template("monthly_reports.html", title=APP_TITLE, trucks=trucks, pdf_path=None)
-
-            groups = {}
-            for r in rows:
-                key = (r["truck_id"], r["truck_name"] or "—")
-                groups.setdefault(key, []).append(r)
-
-            filename = f"Monthly_Report_{start.strftime('%Y_%m')}_All_Trucks.pdf"
-            pdf_full = os.path.join(REPORTS_DIR, filename)
-            os.makedirs(os.path.dirname(pdf_full), exist_ok=True)
-            c = canvas.Canvas(pdf_full, pagesize=letter)
-
-            for (tid, tname), items in groups.items():
-                header_pdf(c, f"Monthly Report: {start.strftime('%B %Y')} — {tname}")
-                y = 9.1*inch
-                c.setFont("Helvetica-Bold", 10)
-                c.drawString(0.8*inch, y, "Date"); c.drawString(1.6*inch, y, "Type"); c.drawString(2.5*inch, y, "Category")
-                c.drawString(4.0*inch, y, "Driver"); c.drawRightString(7.7*inch, y, "Amount")
-                y -= 0.15*inch; c.setFont("Helvetica", 10)
-                total_inc = 0.0; total_exp = 0.0
-                for r in items:
-                    if y < 1.1*inch:
-                        c.showPage(); header_pdf(c, f"Monthly Report: {start.strftime('%B %Y')} — {tname}")
-                        y = 9.1*inch
-                        c.setFont("Helvetica-Bold", 10)
-                        c.drawString(0.8*inch, y, "Date"); c.drawString(1.6*inch, y, "Type"); c.drawString(2.5*inch, y, "Category")
-                        c.drawString(4.0*inch, y, "Driver"); c.drawRightString(7.7*inch, y, "Amount")
-                        y -= 0.15*inch; c.setFont("Helvetica", 10)
-                    amt = r["amount"] if r["is_income"]==1 else amount_with_hst(r["amount"], r["hst_included"]==1)
-                    c.drawString(0.8*inch, y, r["entry_date"])
-                    c.drawString(1.6*inch, y, "Income" if r["is_income"]==1 else "Expense")
-                    c.drawString(2.5*inch, y, r["category"] or "-")
-                    c.drawString(4.0*inch, y, r["driver_name"] or "-")
-                    c.drawRightString(7.7*inch, y, f"${amt:,.2f}")
-                    if r["is_income"]==1: total_inc += amt
-                    else: total_exp += amt
-                    y -= 0.15*inch
-                y -= 0.1*inch; c.setFont("Helvetica-Bold", 11)
-                c.drawRightString(6.9*inch, y, "Total Income:"); c.drawRightString(7.7*inch, y, f"${total_inc:,.2f}")
-                y -= 0.18*inch; c.drawRightString(6.9*inch, y, "Total Expenses:"); c.drawRightString(7.7*inch, y, f"${total_exp:,.2f}")
-                y -= 0.18*inch; net = round(total_inc-total_exp,2)
-                c.setFillColor(colors.green if net>=0 else colors.red)
-                c.drawRightString(6.9*inch, y, "Profit/Loss:"); c.drawRightString(7.7*inch, y, f"${net:,.2f}")
-                c.setFillColor(colors.black)
-                c.showPage()
-
-            inc, exp, prof = totals("date(entry_date)>=? AND date(entry_date)<?", (str(start), str(end)))
-            header_pdf(c, f"Monthly Summary: {start.strftime('%B %Y')} — All Trucks")
-            y = 9.1*inch
-            c.setFont("Helvetica-Bold", 11)
-            c.drawRightString(6.9*inch, y, "Total Income:"); c.drawRightString(7.7*inch, y, f"${inc:,.2f}")
-            y -= 0.18*inch; c.drawRightString(6.9*inch, y, "Total Expenses:"); c.drawRightString(7.7*inch, y, f"${exp:,.2f}")
-            y -= 0.18*inch; c.setFillColor(colors.green if prof>=0 else colors.red)
-            c.drawRightString(6.9*inch, y, "Profit/Loss:"); c.drawRightString(7.7*inch, y, f"${prof:,.2f}")
-            c.setFillColor(colors.black)
-            c.showPage(); c.save()
-            pdf_path = pdf_full
-        else:
-            cur.execute("""SELECT e.*, t.name AS truck_name, d.name AS driver_name
-                           FROM entries e LEFT JOIN trucks t ON e.truck_id=t.id
-                           LEFT JOIN drivers d ON e.driver_id=d.id
-                           WHERE date(entry_date)>=? AND date(entry_date)<? AND truck_id=?
-                           ORDER BY date(entry_date) ASC, id ASC""", (str(start), str(end), truck_id))
-            rows = cur.fetchall()
-            if not rows:
-                flash("No data available for the selected month/truck.", "warning")
-                conn.close()
-                return render_template("monthly_reports.html", title=APP_TITLE, trucks=trucks, pdf_path=None)
-            inc, exp, prof = totals("date(entry_date)>=? AND date(entry_date)<? AND truck_id=?", (str(start), str(end), truck_id))
-            filename = f"Monthly_Report_{start.strftime('%Y_%m')}_Truck_{rows[0]['truck_name']}.pdf"
-            pdf_full = os.path.join(REPORTS_DIR, filename)
-            os.makedirs(os.path.dirname(pdf_full), exist_ok=True)
-            c = canvas.Canvas(pdf_full, pagesize=letter)
-            header_pdf(c, f"Monthly Report: {start.strftime('%B %Y')} — {rows[0]['truck_name']}")
-            y = 9.1*inch
-            c.setFont("Helvetica-Bold", 10)
-            c.drawString(0.8*inch, y, "Date"); c.drawString(1.6*inch, y, "Type"); c.drawString(2.5*inch, y, "Category")
-            c.drawString(4.0*inch, y, "Driver"); c.drawRightString(7.7*inch, y, "Amount")
-            y -= 0.15*inch; c.setFont("Helvetica", 10)
-            for r in rows:
-                if y < 1.1*inch:
-                    c.showPage(); header_pdf(c, f"Monthly Report: {start.strftime('%B %Y')} — {rows[0]['truck_name']}"); y = 9.1*inch
-                    c.setFont("Helvetica-Bold", 10)
-                    c.drawString(0.8*inch, y, "Date"); c.drawString(1.6*inch, y, "Type"); c.drawString(2.5*inch, y, "Category")
-                    c.drawString(4.0*inch, y, "Driver"); c.drawRightString(7.7*inch, y, "Amount")
-                    y -= 0.15*inch; c.setFont("Helvetica", 10)
-                amt = r["amount"] if r["is_income"]==1 else amount_with_hst(r["amount"], r["hst_included"]==1)
-                c.drawString(0.8*inch, y, r["entry_date"])
-                c.drawString(1.6*inch, y, "Income" if r["is_income"]==1 else "Expense")
-                c.drawString(2.5*inch, y, r["category"] or "-")
-                c.drawString(4.0*inch, y, r["driver_name"] or "-")
-                c.drawRightString(7.7*inch, y, f"${amt:,.2f}")
-                y -= 0.15*inch
-            y -= 0.1*inch; c.setFont("Helvetica-Bold", 11)
-            c.drawRightString(6.9*inch, y, "Total Income:"); c.drawRightString(7.7*inch, y, f"${inc:,.2f}")
-            y -= 0.18*inch; c.drawRightString(6.9*inch, y, "Total Expenses:"); c.drawRightString(7.7*inch, y, f"${exp:,.2f}")
-            y -= 0.18*inch; c.setFillColor(colors.green if (inc-exp)>=0 else colors.red)
-            c.drawRightString(6.9*inch, y, "Profit/Loss:"); c.drawRightString(7.7*inch, y, f"${(inc-exp):,.2f}")
-            c.setFillColor(colors.black); c.showPage(); c.save()
-            pdf_path = pdf_full
-    conn.close()
-    return render_template("monthly_reports.html", title=APP_TITLE, trucks=trucks, pdf_path=pdf_path)
+        if request.form.get("background"):
+            job_id = submit_report_job("monthly", truck_id, year, month)
+            if job_id: flash("Report queued.", "info")
+            else: flash("Too many reports are being generated, please try again shortly.", "warning")
+            return render_template("monthly_reports.html", title=APP_TITLE, trucks=trucks, pdf_path=None, job_id=job_id)
+        pdf_path = monthly_report_pdf(conn, truck_id, year, month)
+        if not pdf_path:
+            flash("No data available for the selected month." if truck_id == "all" else "No data available for the selected month/truck.", "warning")
+    return render_template("monthly_reports.html", title=APP_TITLE, trucks=trucks, pdf_path=pdf_path, job_id=job_id)
 
 # ---------- Driver Pay ----------
+DRIVER_PAY_COLUMNS = [
+    ("Date", 0.8, "left", lambda r: r["entry_date"]),
+    ("Driver", 2.0, "left", lambda r: r["driver_name"] or "-"),
+    ("Truck", 4.0, "left", lambda r: r["truck_name"] or "-"),
+    ("Amount", 7.7, "right", lambda r: fmt_cents(r["gross_cents"])),
+]
+
+def build_driver_pay_report(pdf_full, title, items, total):
+    with pdf_canvas(pdf_full, "driver_pay") as c:
+        y = draw_table(c, title, DRIVER_PAY_COLUMNS, items)
+        draw_totals(c, title, y, [("Total Pay:", total, False)], size=12)
+        c.showPage()
+    return True
+
+def driver_pay_filter(driver_id, date_from, date_to):
+    driver = ""; params = [iso_date(date_from), iso_date(date_to)]
+    if driver_id and driver_id != "all":
+        driver = "AND e.driver_id=?"; params.append(driver_id)
+    return driver, params
+
+def driver_pay_cursor(cur, driver_id, date_from, date_to):
+    driver, params = driver_pay_filter(driver_id, date_from, date_to)
+    return cur.execute(DRIVER_PAY_SQL.format(entries=ledger_source(cur.connection, *params[:2]), driver=driver), params)
+
+def driver_pay_total(conn, driver_id, date_from, date_to):
+    driver, params = driver_pay_filter(driver_id, date_from, date_to)
+    return conn.execute(DRIVER_PAY_TOTAL_SQL.format(entries=ledger_source(conn, *params[:2]), driver=driver), params).fetchone()[0]
+
+def driver_pay_report_pdf(conn, driver_id, date_from, date_to, items=None):
+    # Cached or freshly built PDF path, or None when there is nothing to report.
+    if items is None:
+        first, items = peek_rows(driver_pay_cursor(conn.cursor(), driver_id, date_from, date_to))
+        if first is None:
+            return None
+    dname = "All Drivers"
+    if driver_id and driver_id != "all":
+        rw = conn.execute("SELECT name FROM drivers WHERE id=?", (driver_id,)).fetchone()
+        dname = rw["name"] if rw else "Driver"
+    first, last = iso_date(date_from), iso_date(date_to)
+    if not (first and last):
+        return None
+    title = f"Driver Pay: {dname} — {date_from} to {date_to}"
+    first = date.fromisoformat(first); last = date.fromisoformat(last)
+    stamp = data_stamp(conn, first.strftime('%Y-%m'), month_after(last).strftime('%Y-%m'))
+    return cached_report(f"Driver_Pay_{dname.replace(' ','_')}_{date_from}_to_{date_to}",
+                         ("driver_pay", driver_id, str(first), str(last)), stamp,
+                         lambda out: build_driver_pay_report(out, title, items, driver_pay_total(conn, driver_id, date_from, date_to)))
+
 @app.route("/driver_pay", methods=["GET","POST"])
 def driver_pay():
-    conn = get_db(); cur = conn.cursor()
-    cur.execute("SELECT * FROM drivers ORDER BY name"); drivers = cur.fetchall()
-    items = []; pdf_path = None
+    conn = get_db(readonly=True); cur = conn.cursor()
+    if request.method == "GET" and (cached := not_modified(data_version(conn, "ref"))): return cached
+    drivers = ref_lists(conn)[1]
+    items = []; pdf_path = None; job_id = None
     if request.method == "POST":
         driver_id = request.form.get("driver_id")
         date_from = request.form.get("date_from")
         date_to = request.form.get("date_to")
-        where = "is_income=0 AND category='Driver Pay' AND date(entry_date)>=? AND date(entry_date)<=?"
-        params = [date_from, date_to]
-        if driver_id and driver_id != "all":
-            where += " AND driver_id=?"; params.append(driver_id)
-        cur.execute(f"""
-            SELECT e.*, t.name AS truck_name, d.name AS driver_name
-            FROM entries e
-            LEFT JOIN trucks t ON e.truck_id = t.id
-            LEFT JOIN drivers d ON e.driver_id = d.id
-            WHERE {where}
-            ORDER BY date(entry_date) ASC, id ASC
-        """, params)
-        items = cur.fetchall()
+        if not (iso_date(date_from) and iso_date(date_to)):
+            flash("Enter a valid From and To date.", "warning")
+            return render_template("driver_pay.html", title=APP_TITLE, drivers=drivers, items=[], pdf_path=None)
+        if request.form.get("background"):
+            job_id = submit_report_job("driver_pay", driver_id, date_from, date_to)
+            if job_id: flash("Report queued.", "info")
+            else: flash("Too many reports are being generated, please try again shortly.", "warning")
+            return render_template("driver_pay.html", title=APP_TITLE, drivers=drivers, items=[], pdf_path=None, job_id=job_id)
+        try:
+            items = driver_pay_cursor(cur, driver_id, date_from, date_to).fetchall()
+        except ValueError as e:
+            flash(str(e), "warning")
+            return render_template("driver_pay.html", title=APP_TITLE, drivers=drivers, items=[], pdf_path=None)
         if not items:
             flash("No data available for that date range/driver.", "warning")
-            conn.close()
             return render_template("driver_pay.html", title=APP_TITLE, drivers=drivers, items=[], pdf_path=None)
-        total = 0.0
-        for r in items:
-            total += amount_with_hst(r["amount"], r["hst_included"]==1)
-        dname = "All Drivers"
-        if driver_id and driver_id != "all":
-            cur.execute("SELECT name FROM drivers WHERE id=?", (driver_id,)); rw = cur.fetchone()
-            dname = rw["name"] if rw else "Driver"
-        title = f"Driver Pay: {dname} — {date_from} to {date_to}"
-        filename = f"Driver_Pay_{dname.replace(' ','_')}_{date_from}_to_{date_to}.pdf"
-        pdf_full = os.path.join(REPORTS_DIR, filename)
-        os.makedirs(os.path.dirname(pdf_full), exist_ok=True)
-        c = canvas.Canvas(pdf_full, pagesize=letter)
-        header_pdf(c, title)
-        y = 9.1*inch
-        c.setFont("Helvetica-Bold", 10)
-        c.drawString(0.8*inch, y, "Date"); c.drawString(2.0*inch, y, "Driver"); c.drawString(4.0*inch, y, "Truck"); c.drawRightString(7.7*inch, y, "Amount")
-        y -= 0.15*inch; c.setFont("Helvetica", 10)
+        pdf_path = driver_pay_report_pdf(conn, driver_id, date_from, date_to, items)
+    return render_template("driver_pay.html", title=APP_TITLE, drivers=drivers, items=items, pdf_path=pdf_path, job_id=job_id)
+
+# ---------- HST Return ----------
+# HST collected on income vs. paid on expenses (input tax credits) per filing period, read from tax_rollups
+# so a multi-year comparison only touches a few rows per month.
+HST_PERIODS = {
+    "monthly": "month",
+    "quarterly": "substr(month, 1, 4) || '-Q' || ((CAST(substr(month, 6, 2) AS INTEGER) + 2) / 3)",
+    "annual": "substr(month, 1, 4)",
+}
+HST_SQL = """
+    SELECT {period} AS period, truck_id, category,
+           SUM(CASE WHEN is_income=1 THEN hst_cents ELSE 0 END) AS collected,
+           SUM(CASE WHEN is_income=0 THEN hst_cents ELSE 0 END) AS paid
+    FROM tax_rollups WHERE month>=? AND month<?
+    GROUP BY 1, 2, 3 ORDER BY 1
+"""
+HST_COLUMNS = [
+    ("By", 0.8, "left", lambda r: r[0]),
+    ("Name", 1.7, "left", lambda r: r[1]),
+    ("HST Collected", 5.1, "right", lambda r: fmt_cents(r[2])),
+    ("HST Paid (ITCs)", 6.4, "right", lambda r: fmt_cents(r[3])),
+    ("Net Tax", 7.7, "right", lambda r: fmt_cents(r[2]-r[3])),
+]
+
+def hst_summary(conn, period, month_from, month_to):
+    # One dict per period, oldest first: collected/paid/net in cents plus per-truck and per-category
+    # (name, collected, paid) lists. month_from inclusive, month_to exclusive, both 'YYYY-MM'.
+    names = {r["id"]: r["name"] for r in conn.execute("SELECT id, name FROM trucks")}
+    periods = []
+    rows = conn.execute(HST_SQL.format(period=HST_PERIODS[period]), (month_from, month_to))
+    for label, items in itertools.groupby(rows, key=lambda r: r["period"]):
+        trucks = {}; categories = {}
         for r in items:
-            if y < 1.1*inch:
-                c.showPage(); header_pdf(c, title); y = 9.1*inch
-                c.setFont("Helvetica-Bold", 10)
-                c.drawString(0.8*inch, y, "Date"); c.drawString(2.0*inch, y, "Driver"); c.drawString(4.0*inch, y, "Truck"); c.drawRightString(7.7*inch, y, "Amount")
-                y -= 0.15*inch; c.setFont("Helvetica", 10)
-            amt = amount_with_hst(r["amount"], r["hst_included"]==1)
-            c.drawString(0.8*inch, y, r["entry_date"])
-            c.drawString(2.0*inch, y, r["driver_name"] or "-")
-            c.drawString(4.0*inch, y, r["truck_name"] or "-")
-            c.drawRightString(7.7*inch, y, f"${amt:,.2f}")
-            y -= 0.15*inch
-        y -= 0.1*inch; c.setFont("Helvetica-Bold", 12)
-        c.drawRightString(6.9*inch, y, "Total Pay:"); c.drawRightString(7.7*inch, y, f"${total:,.2f}")
-        c.showPage(); c.save()
-        pdf_path = pdf_full
-    conn.close()
-    return render_template("driver_pay.html", title=APP_TITLE, drivers=drivers, items=items, pdf_path=pdf_path)
+            for split, name in ((trucks, names.get(r["truck_id"], "—")), (categories, r["category"] or "-")):
+                c, p = split.get(name, (0, 0)); split[name] = (c + r["collected"], p + r["paid"])
+        collected = sum(v[0] for v in trucks.values()); paid = sum(v[1] for v in trucks.values())
+        periods.append({"period": label, "collected": collected, "paid": paid, "net": collected - paid,
+                        "trucks": [(n, *v) for n, v in sorted(trucks.items())],
+                        "categories": [(n, *v) for n, v in sorted(categories.items())]})
+    return periods
+
+def build_hst_report(pdf_full, title, periods):
+    if not periods:
+        return False
+    with pdf_canvas(pdf_full, "hst") as c:
+        y = draw_table(c, title, HST_COLUMNS, [("Period", p["period"], p["collected"], p["paid"]) for p in periods])
+        collected = sum(p["collected"] for p in periods); paid = sum(p["paid"] for p in periods)
+        draw_totals(c, title, y, [("HST Collected:", collected, False), ("HST Paid (ITCs):", paid, False), ("Net Tax:", collected-paid, False)])
+        c.showPage()
+        for p in periods:
+            ptitle = f"{title} — {p['period']}"
+            rows = [("Truck", *t) for t in p["trucks"]] + [("Category", *t) for t in p["categories"]]
+            y = draw_table(c, ptitle, HST_COLUMNS, rows)
+            draw_totals(c, ptitle, y, [("HST Collected:", p["collected"], False), ("HST Paid (ITCs):", p["paid"], False), ("Net Tax:", p["net"], False)])
+            c.showPage()
+    return True
+
+def hst_report_pdf(conn, period, year_from, year_to, periods):
+    label = str(year_from) if year_from == year_to else f"{year_from}-{year_to}"
+    stamp = data_stamp(conn, f"{year_from:04d}-01", f"{year_to+1:04d}-01")
+    return cached_report(f"HST_Return_{period.title()}_{label}", ("hst", period, year_from, year_to), stamp,
+                         lambda out: build_hst_report(out, f"HST Return ({period.title()}): {label}", periods))
+
+@app.route("/hst", methods=["GET","POST"])
+def hst():
+    conn = get_db(readonly=True)
+    if request.method == "GET" and (cached := not_modified(data_version(conn))): return cached
+    period = request.values.get("period")
+    if period not in HST_PERIODS: period = "quarterly"
+    try:
+        year_from = int(request.values.get("year_from") or date.today().year)
+        year_to = int(request.values.get("year_to") or year_from)
+    except ValueError:
+        flash("Years must be numbers.", "warning")
+        year_from = year_to = date.today().year
+    if year_to < year_from: year_from, year_to = year_to, year_from
+    periods = hst_summary(conn, period, f"{year_from:04d}-01", f"{year_to+1:04d}-01")
+    pdf_path = None
+    if request.method == "POST":
+        pdf_path = hst_report_pdf(conn, period, year_from, year_to, periods)
+        if not pdf_path: flash("No data available for the selected years.", "warning")
+    return render_template("hst.html", title=APP_TITLE, period=period, year_from=year_from, year_to=year_to,
+                           periods=periods, pdf_path=pdf_path)
+
+# ---------- Year-end report packs ----------
+# Every per-truck and all-trucks monthly report plus a driver-pay statement per driver for one year,
+# rendered in worker processes (one task per month, reading that month once for all of its reports;
+# one per driver) and streamed back as a ZIP in the order the parts finish.
+YEAR_PACK_WORKERS = max(1, min(4, os.cpu_count() or 1))
+
+def pdf_bytes(render, *args):
+    buf = io.BytesIO(); render(buf, *args)
+    return buf.getvalue()
+
+def render_month_pack(year, month):
+    start = date(year, month, 1)
+    conn = connect_db(readonly=True)
+    try:
+        rows = conn.execute(MONTHLY_ALL_SQL.format(entries=ledger_source(conn, str(start), str(start))), (str(start), str(month_after(start)))).fetchall()
+        by_truck = truck_totals(conn, start.strftime('%Y-%m'), month_after(start).strftime('%Y-%m'))
+    finally:
+        conn.close()
+    if not rows:
+        return []
+    label = start.strftime('%Y_%m')
+    parts = [(f"{label}/Monthly_Report_{label}_All_Trucks.pdf", pdf_bytes(render_monthly_report, start, rows, by_truck))]
+    for (tid, tname), items in itertools.groupby(rows, key=lambda r: (r["truck_id"], r["truck_name"] or "—")):
+        items = sorted(items, key=lambda r: (r["entry_date"], r["id"]))
+        parts.append((f"{label}/Monthly_Report_{label}_Truck_{secure_filename(tname) or tid}.pdf",
+                      pdf_bytes(render_monthly_report, start, items, {tid: by_truck.get(tid or 0, (0, 0, 0))}, tname)))
+    return parts
+
+def render_driver_pack(year, driver_id, driver_name):
+    date_from, date_to = f"{year}-01-01", f"{year}-12-31"
+    conn = connect_db(readonly=True)
+    try:
+        rows = driver_pay_cursor(conn.cursor(), driver_id, date_from, date_to).fetchall()
+        total = driver_pay_total(conn, driver_id, date_from, date_to)
+    finally:
+        conn.close()
+    if not rows:
+        return []
+    title = f"Driver Pay: {driver_name} — {date_from} to {date_to}"
+    return [(f"Driver_Pay/Driver_Pay_{secure_filename(driver_name) or driver_id}_{year}.pdf",
+             pdf_bytes(build_driver_pay_report, title, rows, total))]
+
+def year_pack_parts(year, drivers):
+    pool = ProcessPoolExecutor(max_workers=YEAR_PACK_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    try:
+        futures = [pool.submit(render_month_pack, year, m) for m in range(1, 13)]
+        futures += [pool.submit(render_driver_pack, year, d["id"], d["name"]) for d in drivers]
+        for done in as_completed(futures):
+            for name, data in done.result():
+                yield f"DD_Reports_{year}/{name}", [data]
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+@app.route("/monthly_reports/year_pack", methods=["POST"])
+def year_pack():
+    try:
+        year = int(request.form.get("year"))
+    except (TypeError, ValueError):
+        flash("Choose a year for the report pack.", "warning")
+        return redirect(url_for("monthly_reports"))
+    drivers = [{"id": r["id"], "name": r["name"]} for r in ref_lists(get_db(readonly=True))[1]]
+    return Response(stream_zip(year_pack_parts(year, drivers)), mimetype="application/zip",
+                    headers={"Content-Disposition": f"attachment; filename=DD_Reports_{year}.zip"})
+
+# ---------- Background report jobs ----------
+# Long reports can be handed to a small thread pool in each worker; the job row in report_jobs is what
+# /report_jobs/<id> polls, so any gunicorn worker can answer for a job another worker is running.
+# A unique index on job_key over queued/running rows deduplicates identical requests across workers.
+REPORT_WORKERS = 2
+REPORT_QUEUE_LIMIT = 8
+REPORT_JOB_TIMEOUT = 600
+REPORT_BUILDERS = {"monthly": monthly_report_pdf, "driver_pay": driver_pay_report_pdf}
+_report_pool = None
+_report_pending = 0
+_report_lock = threading.Lock()
+
+def report_pool():
+    global _report_pool
+    with _report_lock:
+        if _report_pool is None:
+            _report_pool = ThreadPoolExecutor(max_workers=REPORT_WORKERS, thread_name_prefix="report")
+        return _report_pool
+
+def submit_report_job(kind, *args):
+    # Returns the job id (an existing one for identical pending parameters), or None when the queue is full.
+    global _report_pending
+    job_key = hashlib.sha256(f"{kind}|{args!r}".encode()).hexdigest()
+    conn = get_db()
+    conn.execute("""UPDATE report_jobs SET status='failed', error='timed out', finished=CURRENT_TIMESTAMP
+                    WHERE status IN ('queued','running') AND created < datetime('now', ?)""", (f"-{REPORT_JOB_TIMEOUT} seconds",))
+    conn.execute("DELETE FROM report_jobs WHERE created < datetime('now', '-1 day')")
+    conn.commit()
+    rw = conn.execute("SELECT id FROM report_jobs WHERE job_key=? AND status IN ('queued','running')", (job_key,)).fetchone()
+    if rw:
+        return rw["id"]
+    with _report_lock:
+        if _report_pending >= REPORT_QUEUE_LIMIT:
+            return None
+        _report_pending += 1
+    job_id = uuid.uuid4().hex
+    try:
+        conn.execute("INSERT INTO report_jobs(id, job_key, kind, status) VALUES (?,?,?,'queued')", (job_id, job_key, kind))
+        conn.commit()
+    except sqlite3.IntegrityError:
+        with _report_lock: _report_pending -= 1
+        rw = conn.execute("SELECT id FROM report_jobs WHERE job_key=? AND status IN ('queued','running')", (job_key,)).fetchone()
+        return rw["id"] if rw else None
+    report_pool().submit(run_report_job, job_id, kind, args)
+    return job_id
+
+def run_report_job(job_id, kind, args):
+    global _report_pending
+    try:
+        with app.app_context():
+            conn = get_db()
+            conn.execute("UPDATE report_jobs SET status='running' WHERE id=?", (job_id,)); conn.commit()
+            try:
+                path = REPORT_BUILDERS[kind](get_db(readonly=True), *args)
+            except Exception as e:
+                app.logger.exception("report job %s failed", job_id)
+                conn.execute("UPDATE report_jobs SET status='failed', error=?, finished=CURRENT_TIMESTAMP WHERE id=?", (str(e), job_id))
+            else:
+                conn.execute("UPDATE report_jobs SET status=?, fname=?, finished=CURRENT_TIMESTAMP WHERE id=?",
+                             ("done" if path else "empty", os.path.basename(path) if path else None, job_id))
+            conn.commit()
+    finally:
+        with _report_lock: _report_pending -= 1
+
+@app.route("/report_jobs/<job_id>")
+def report_job(job_id):
+    rw = get_db(readonly=True).execute("SELECT * FROM report_jobs WHERE id=?", (job_id,)).fetchone()
+    if not rw:
+        return jsonify(error="Unknown report job."), 404
+    body = {"id": rw["id"], "kind": rw["kind"], "status": rw["status"], "error": rw["error"]}
+    if rw["status"] == "done":
+        body["download_url"] = url_for("download_report", fname=rw["fname"])
+        if request.args.get("download"):
+            return redirect(body["download_url"])
+    return jsonify(body)
+
+# ---------- Analytics ----------
+# Monthly income/expense/profit series per truck and per driver, expenses by category, trailing averages and
+# year-over-year changes. One query reads entries into a columnar snapshot (one NumPy array per column,
+# fetched in chunks so the row tuples never all exist at once) and every series is a bincount over it.
+# Each process keeps the snapshot until the data-version stamp moves, i.e. until the next write; the
+# columns of archived years never change, so those are read once per process. NumPy is imported where
+# it is used, so workers that never serve analytics don't load it.
+ANALYTICS_SNAPSHOT_SQL = f"""
+    SELECT CAST(substr(entry_date, 1, 4) AS INTEGER)*12 + CAST(substr(entry_date, 6, 2) AS INTEGER) - 1,
+           IFNULL(truck_id, 0), IFNULL(driver_id, 0), IFNULL(category, ''), is_income, {GROSS_CENTS.format(e='')}
+    FROM {{entries}} WHERE entry_date GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-*'
+"""
+ANALYTICS_CHUNK = 100000
+# Snapshot columns and their dtypes: months, ids and category codes fit int32, cents need int64.
+ANALYTICS_COLUMNS = (("month", "int32"), ("truck", "int32"), ("driver", "int32"), ("category", "int32"),
+                     ("income", "bool"), ("cents", "int64"))
+# (stamp, snapshot, archive key, rows and categories at its front that came from archive files)
+_analytics_snapshot = None
+
+def snapshot_columns(conn, source):
+    # ([month, truck, driver, category code, is_income, cents] arrays, category names) for one entries table.
+    import numpy as np
+    codes = {}; chunks = []
+    cur = conn.cursor(); cur.row_factory = None  # plain tuples: Row objects cost ~20% on a million rows
+    cur.execute(ANALYTICS_SNAPSHOT_SQL.format(entries=source))
+    while (rows := cur.fetchmany(ANALYTICS_CHUNK)):
+        month, truck, driver, category, income, cents = zip(*rows)
+        category = [codes.setdefault(c, len(codes)) for c in category]
+        chunks.append([np.array(col, dtype=t) for col, (_, t) in zip((month, truck, driver, category, income, cents), ANALYTICS_COLUMNS)])
+    cols = [np.concatenate(col) for col in zip(*chunks)] if chunks else [np.zeros(0, dtype=t) for _, t in ANALYTICS_COLUMNS]
+    return cols, list(codes)
+
+def analytics_snapshot(conn):
+    # Archived years sit at the front of the snapshot and are only read from their files when the set of
+    # archives changes; otherwise a refresh reuses that front part, so one copy of it stays resident.
+    import numpy as np
+    global _analytics_snapshot
+    stamp = data_version(conn)
+    cached = _analytics_snapshot
+    if cached is None or cached[0] != stamp:
+        closed = sorted(archived_years(conn).items())
+        key = tuple((year, info["archived"]) for year, info in closed)
+        if cached is not None and cached[2] == key:
+            _, old, _, n_rows, n_codes = cached
+            parts = [[old[name][:n_rows] for name, _ in ANALYTICS_COLUMNS]]
+            codes = {c: i for i, c in enumerate(old["categories"][:n_codes])}
+        else:
+            parts = []; codes = {}
+            for year, info in closed:
+                attach_archives(conn, [year])
+                parts.append(remap_categories(*snapshot_columns(conn, f"arch_{year}.entries"), codes))
+                conn.execute(f"DETACH arch_{year}")
+        n_rows = sum(len(part[0]) for part in parts); n_codes = len(codes)
+        parts.append(remap_categories(*snapshot_columns(conn, "entries"), codes))
+        snap = dict(zip([name for name, _ in ANALYTICS_COLUMNS], (np.concatenate(col) for col in zip(*parts))), categories=list(codes))
+        cached = _analytics_snapshot = (stamp, snap, key, n_rows, n_codes)
+    return cached[1]
+
+def remap_categories(cols, names, codes):
+    # Renumbers one table's category codes into codes (name -> code, shared by the whole snapshot).
+    import numpy as np
+    remap = np.array([codes.setdefault(c, len(codes)) for c in names] or [0], dtype=np.int32)
+    return cols[:3] + [remap[cols[3]]] + cols[4:]
+
+def month_matrix(keys, months, cents, n_keys, n_months):
+    # Sums cents into an (n_keys, n_months) matrix.
+    import numpy as np
+    return np.bincount(keys.astype(np.int64) * n_months + months, weights=cents, minlength=n_keys * n_months).reshape(n_keys, n_months)
+
+def trailing_mean(x, window):
+    import numpy as np
+    out = np.full(x.shape, np.nan)
+    if x.shape[-1] >= window:
+        c = np.cumsum(x, axis=-1)
+        before = np.concatenate([np.zeros(x.shape[:-1] + (1,)), c[..., :-window]], axis=-1)
+        out[..., window-1:] = (c[..., window-1:] - before) / window
+    return out
+
+def year_over_year(x):
+    import numpy as np
+    out = np.full(x.shape, np.nan)
+    out[..., 12:] = x[..., 12:] - x[..., :-12]
+    return out
+
+def dollars(values):
+    return [None if math.isnan(v) else round(v / 100, 2) for v in values.tolist()]
+
+def month_index(value):
+    m = re.fullmatch(r"(\d{4})-(\d{2})", value or "")
+    return int(m.group(1))*12 + int(m.group(2)) - 1 if m and 1 <= int(m.group(2)) <= 12 else None
+
+def analytics_data(conn, args):
+    # args: from/to ('YYYY-MM', inclusive), truck_id, window (months in the trailing average, default 3).
+    import numpy as np
+    snap = analytics_snapshot(conn)
+    try:
+        window = min(max(int(args.get("window") or 3), 1), 24)
+    except ValueError:
+        window = 3
+    cols = {k: v for k, v in snap.items() if k != "categories"}
+    if args.get("truck_id", "").isdigit():
+        keep = snap["truck"] == int(args["truck_id"])
+        cols = {k: v[keep] for k, v in cols.items()}
+    month = cols["month"]
+    if not len(month):
+        return {"months": [], "window": window, "total": None, "trucks": [], "drivers": [], "categories": []}
+    first = int(month.min()); n = int(month.max()) - first + 1
+    lo = month_index(args.get("from")); hi = month_index(args.get("to"))
+    span = slice(max(0, lo - first) if lo is not None else 0, max(0, hi - first + 1) if hi is not None else n)
+    cols["month"] = month - first; cols["all"] = np.zeros_like(month)
+    inc_cols = {k: v[cols["income"]] for k, v in cols.items()}; exp_cols = {k: v[~cols["income"]] for k, v in cols.items()}
+
+    def series(key):
+        # One row per distinct id: income, expense and profit plus the profit's trailing mean and YoY change.
+        n_ids = int(cols[key].max()) + 1; keys = np.flatnonzero(np.bincount(cols[key], minlength=n_ids))
+        inc, exp = (month_matrix(c[key], c["month"], c["cents"], n_ids, n)[keys] for c in (inc_cols, exp_cols))
+        profit = inc - exp; avg = trailing_mean(profit, window); yoy = year_over_year(profit)
+        return [(k, {"income": dollars(inc[i, span]), "expense": dollars(exp[i, span]), "profit": dollars(profit[i, span]),
+                     "profit_avg": dollars(avg[i, span]), "profit_yoy": dollars(yoy[i, span])})
+                for i, k in enumerate(keys.tolist())]
+
+    trucks, drivers = ref_lists(conn)
+    names = ({r["id"]: r["name"] for r in trucks}, {r["id"]: r["name"] for r in drivers})
+    cats = exp_cols["category"]
+    by_cat = month_matrix(cats, exp_cols["month"], exp_cols["cents"], len(snap["categories"]), n)
+    cat_avg = trailing_mean(by_cat, window); cat_yoy = year_over_year(by_cat)
+    months = [f"{(first+i)//12:04d}-{(first+i)%12+1:02d}" for i in range(n)][span]
+    return {
+        "months": months, "window": window,
+        "total": series("all")[0][1],
+        "trucks": [{"id": k, "name": names[0].get(k, "—"), **v} for k, v in series("truck")],
+        "drivers": [{"id": k, "name": names[1].get(k, "—"), **v} for k, v in series("driver")],
+        "categories": [{"category": snap["categories"][i] or "-", "expense": dollars(by_cat[i, span]),
+                        "expense_avg": dollars(cat_avg[i, span]), "expense_yoy": dollars(cat_yoy[i, span]),
+                        "total": round(by_cat[i, span].sum() / 100, 2)}
+                       for i in sorted(np.unique(cats).tolist(), key=lambda i: snap["categories"][i])],
+    }
+
+@app.route("/analytics")
+def analytics():
+    conn = get_db(readonly=True)
+    if (cached := not_modified(data_version(conn))): return cached
+    return render_template("analytics.html", title=APP_TITLE, data=analytics_data(conn, request.args), trucks=ref_lists(conn)[0])
+
+@app.route("/api/analytics")
+def api_analytics():
+    conn = get_db(readonly=True)
+    if (cached := not_modified(data_version(conn))): return cached
+    return jsonify(analytics_data(conn, request.args))
+
+# ---------- JSON API ----------
+# For the driver phone app: reference lists, and batched entry submission. Each entry in a batch carries a
+# client-generated "key"; a key that is already stored returns its entry instead of inserting again, so a
+# phone can resend a whole day after a dropped connection. Entries use the bulk-import field names and
+# go through the same clean_entry() rules; a batch is stored in one transaction or not at all.
+API_BATCH_LIMIT = 1000
+
+def api_ref(r):
+    return {"id": r["id"], "name": r["name"]}
+
+@app.route("/api/trucks")
+@app.route("/api/drivers")
+def api_ref_list():
+    conn = get_db(readonly=True)
+    if (cached := not_modified(data_version(conn, "ref"))): return cached
+    kind = request.path.rsplit("/", 1)[1]
+    rows = ref_lists(conn)[0 if kind == "trucks" else 1]
+    return jsonify({kind: [api_ref(r) for r in rows]})
+
+@app.route("/api/trucks/<int:id>")
+@app.route("/api/drivers/<int:id>")
+def api_ref_item(id):
+    kind = request.path.split("/")[2]
+    for r in ref_lists(get_db(readonly=True))[0 if kind == "trucks" else 1]:
+        if r["id"] == id:
+            return jsonify(api_ref(r))
+    return jsonify(error=f"Unknown {kind[:-1]} {id}."), 404
+
+@app.route("/api/entries/batch", methods=["POST"])
+def api_entries_batch():
+    body = request.get_json(silent=True)
+    items = body.get("entries") if isinstance(body, dict) else None
+    if not isinstance(items, list) or not items:
+        return jsonify(error='Expected a JSON object with a non-empty "entries" list.'), 400
+    if len(items) > API_BATCH_LIMIT:
+        return jsonify(error=f"At most {API_BATCH_LIMIT} entries per batch."), 413
+
+    errors = []; keys = []
+    for i, item in enumerate(items):
+        key = item.get("key") if isinstance(item, dict) else None
+        if not isinstance(key, str) or not key.strip() or len(key) > 200:
+            errors.append({"index": i, "key": key, "errors": ['Each entry needs a "key" string (up to 200 characters).']})
+        elif key in keys:
+            errors.append({"index": i, "key": key, "errors": ["Key repeated within the batch."]})
+        keys.append(key)
+    if errors:
+        return jsonify(errors=errors), 422
+
+    conn = get_db(); cur = conn.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        stored = {}
+        for chunk in range(0, len(keys), 500):
+            part = keys[chunk:chunk+500]
+            stored.update((r["key"], r) for r in cur.execute(
+                f"SELECT * FROM idempotency_keys WHERE key IN ({','.join('?'*len(part))})", part))
+        trucks = name_map(cur, "trucks"); drivers = name_map(cur, "drivers"); closed = archived_years(conn)
+        results = []; new = []
+        for i, (key, item) in enumerate(zip(keys, items)):
+            rec = {k: v for k, v in item.items() if k != "key"}
+            fingerprint = hashlib.sha256(json.dumps(rec, sort_keys=True, default=str).encode()).hexdigest()
+            if key in stored:
+                if stored[key]["fingerprint"] != fingerprint:
+                    errors.append({"index": i, "key": key, "errors": ["Key already used for a different entry."]})
+                results.append({"key": key, "entry_id": stored[key]["entry_id"], "status": "duplicate"})
+                continue
+            fields, problems = import_fields(rec, trucks, drivers)
+            row, more = clean_entry(fields, closed)
+            if problems or more:
+                errors.append({"index": i, "key": key, "errors": problems + more}); continue
+            new.append((len(results), key, fingerprint, row))
+            results.append({"key": key, "entry_id": None, "status": "created"})
+        if errors:
+            conn.rollback()
+            return jsonify(errors=errors), 422
+        after_id = cur.execute("SELECT IFNULL(MAX(id), 0) FROM entries").fetchone()[0]
+        for n, key, fingerprint, row in new:
+            cur.execute(INSERT_ENTRY_SQL, row)
+            results[n]["entry_id"] = cur.lastrowid
+            cur.execute("INSERT INTO idempotency_keys(key, entry_id, fingerprint) VALUES (?, ?, ?)", (key, cur.lastrowid, fingerprint))
+        if new:
+            rollup_since(cur, after_id)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return jsonify(results=results), 201 if new else 200
+
+# ---------- Backups ----------
+# `flask backup` writes a full snapshot to BACKUP_DIR through SQLite's online backup API, BACKUP_STEP_PAGES
+# pages per step, so it runs beside the app: WAL writers are never blocked and no read transaction is held
+# long enough to stall checkpoints. `--incremental` ships only the change_log rows after the previous
+# backup, as gzipped JSON lines. Each file gets a <file>.json manifest (kind, last change_log seq it
+# covers, sha256), and `flask restore-backup OUT --at TIME` rebuilds the database as of TIME from the
+# newest full snapshot before it plus the incrementals after it. DD_BACKUP_EVERY_MIN runs backups from
+# every worker's scheduler thread (incremental, or full once the newest snapshot is DD_BACKUP_FULL_HOURS
+# old); DD_BACKUP_KEEP full snapshots are kept, with their incrementals. change_log is only written from
+# the first full backup on, and is pruned to what the newest backup does not hold yet. Archive files are
+# written once and are not included: back ARCHIVE_DIR up alongside.
+BACKUP_EVERY_MIN = float(os.environ.get("DD_BACKUP_EVERY_MIN", "0"))
+BACKUP_FULL_HOURS = float(os.environ.get("DD_BACKUP_FULL_HOURS", "24"))
+BACKUP_KEEP = int(os.environ.get("DD_BACKUP_KEEP", "7"))
+BACKUP_STEP_PAGES = 256
+# A write from another connection between two steps restarts the copy; after this many it is finished in
+# one step, which reads a single snapshot (still without blocking writers).
+BACKUP_MAX_RESTARTS = 20
+_backup_lock = threading.Lock()
+_backup_thread = None
+_backup_thread_lock = threading.Lock()
+
+class BackupRestarted(Exception):
+    pass
+
+def utc_stamp(t=None):
+    # Same format as change_log.at, so the two compare as strings.
+    return (t or datetime.now(timezone.utc)).strftime("%Y-%m-%dT%H:%M:%S.%f")[:23] + "Z"
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+@contextmanager
+def backup_lock(wait=True):
+    # One backup at a time across threads and, through flock where there is one, gunicorn workers.
+    # Yields False instead of waiting when wait=False and another backup holds it.
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    if not _backup_lock.acquire(blocking=wait):
+        yield False
+        return
+    try:
+        with open(os.path.join(BACKUP_DIR, ".lock"), "w") as f:
+            locked = True
+            if fcntl:
+                try: fcntl.flock(f, fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+                except BlockingIOError: locked = False
+            yield locked
+    finally:
+        _backup_lock.release()
+
+def backup_manifests():
+    # Every backup's manifest, oldest first.
+    manifests = []
+    for p in glob.glob(os.path.join(BACKUP_DIR, "*.json")):
+        with open(p) as f: manifests.append(json.load(f))
+    return sorted(manifests, key=lambda m: (m["created"], m["name"]))
+
+def snapshot_db(dest):
+    # Online copy of the database into dest; returns (seq, at) of the last change_log row it holds.
+    src = connect_db(readonly=True)
+    dst = sqlite3.connect(dest)
+    try:
+        last = [None, 0]
+        def progress(status, remaining, total):
+            if last[0] is not None and remaining >= last[0]:
+                last[1] += 1
+                if last[1] > BACKUP_MAX_RESTARTS: raise BackupRestarted()
+            last[0] = remaining
+        try:
+            src.backup(dst, pages=BACKUP_STEP_PAGES, progress=progress)
+        except BackupRestarted:
+            src.backup(dst)
+        dst.execute("PRAGMA journal_mode=DELETE")  # one self-contained file
+        r = dst.execute("SELECT seq, at FROM change_log ORDER BY seq DESC LIMIT 1").fetchone()
+        return tuple(r) if r else (0, "")
+    finally:
+        dst.close(); src.close()
+
+def write_changes(conn, after, dest):
+    # change_log rows after seq `after` into dest as gzipped JSON lines; returns (rows, seq, at) of the last.
+    n, seq, at = 0, after, ""
+    with gzip.open(dest, "wt", encoding="utf-8") as f:
+        for r in conn.execute("SELECT seq, at, tbl, op, row_key, data FROM change_log WHERE seq>? ORDER BY seq", (after,)):
+            f.write(json.dumps(dict(r)) + "\n")
+            n += 1; seq, at = r["seq"], r["at"]
+    return n, seq, at
+
+def run_backup(kind="full", wait=True):
+    # kind: "full", "incremental" or "auto" (what the schedule is due). Returns the manifest written, or
+    # None when there was nothing to do. ValueError for an incremental with no full backup to follow.
+    with backup_lock(wait) as locked:
+        if not locked:
+            return None
+        manifests = backup_manifests()
+        fulls = [m for m in manifests if m["kind"] == "full"]
+        now = datetime.now(timezone.utc)
+        with closing(connect_db()) as conn:
+            # Incrementals continue from the newest backup, as long as this database still holds the change it
+            # ended on (a database restored from an older backup has a different history).
+            prev = manifests[-1] if manifests else None
+            follows = bool(fulls) and (not prev["seq"] or (conn.execute("SELECT at FROM change_log WHERE seq=?", (prev["seq"],)).fetchone() or [None])[0] == prev["last_at"])
+            if kind == "auto":
+                if prev and prev["created"] > utc_stamp(now - timedelta(minutes=BACKUP_EVERY_MIN / 2)):
+                    return None  # another worker just ran it
+                kind = "incremental" if follows and fulls[-1]["created"] > utc_stamp(now - timedelta(hours=BACKUP_FULL_HOURS)) else "full"
+            if kind == "incremental" and not follows:
+                raise ValueError("No full backup of this database to follow; run `flask backup` first.")
+            stem = f"{os.path.splitext(os.path.basename(DB_PATH))[0]}-{now:%Y%m%dT%H%M%S}Z-{kind}"
+            tmp = os.path.join(BACKUP_DIR, f".{stem}.{os.getpid()}.tmp")
+            try:
+                if kind == "full":
+                    # Log from before the snapshot on; changes it already holds are skipped by seq.
+                    conn.execute("INSERT OR IGNORE INTO backups_enabled VALUES (1)"); conn.commit()
+                    seq, at = snapshot_db(tmp)
+                    manifest = {"name": f"{stem}-{seq}.db", "kind": kind, "seq": seq, "last_at": at}
+                else:
+                    n, seq, at = write_changes(conn, prev["seq"], tmp)
+                    if not n:
+                        return None
+                    manifest = {"name": f"{stem}-{prev['seq']+1}-{seq}.jsonl.gz", "kind": kind, "after": prev["seq"],
+                                "seq": seq, "last_at": at, "changes": n}
+                path = os.path.join(BACKUP_DIR, manifest["name"])
+                manifest.update(created=utc_stamp(), bytes=os.path.getsize(tmp), sha256=file_sha256(tmp))
+                os.replace(tmp, path)
+            finally:
+                if os.path.exists(tmp): os.remove(tmp)
+            with open(tmp, "w") as f: json.dump(manifest, f, indent=1)
+            os.replace(tmp, path + ".json")
+            rotate_backups()
+            prune_change_log(conn, locked=True)
+        return manifest
+
+def rotate_backups():
+    # Keeps the newest BACKUP_KEEP full snapshots and the incrementals after the oldest of them.
+    manifests = backup_manifests()
+    fulls = [m for m in manifests if m["kind"] == "full"]
+    if not fulls:
+        return
+    oldest = fulls[-BACKUP_KEEP:][0]
+    for m in manifests:
+        if m["created"] < oldest["created"]:
+            for p in (m["name"], m["name"] + ".json"):
+                try: os.remove(os.path.join(BACKUP_DIR, p))
+                except FileNotFoundError: pass
+
+def prune_change_log(conn, locked=False):
+    # Drops the change_log rows already in a backup file, all but the newest backup's last one (incrementals
+    # check that they follow on from it). With no backups in BACKUP_DIR nothing needs the log, so logging
+    # stops until the next full backup. Runs after every backup and import (migration 12 cleared what older
+    # versions logged); skipped while another process is backing up (it prunes when done).
+    with (nullcontext(True) if locked or not os.path.isdir(BACKUP_DIR) else backup_lock(wait=False)) as free:
+        if not free:
+            return
+        manifests = backup_manifests()
+        if not manifests:
+            if conn.execute("SELECT EXISTS (SELECT 1 FROM backups_enabled) OR EXISTS (SELECT 1 FROM change_log)").fetchone()[0]:
+                conn.execute("DELETE FROM backups_enabled"); conn.execute("DELETE FROM change_log"); conn.commit()
+        elif conn.execute("SELECT 1 FROM change_log WHERE seq<? LIMIT 1", (manifests[-1]["seq"],)).fetchone():
+            conn.execute("DELETE FROM change_log WHERE seq<?", (manifests[-1]["seq"],)); conn.commit()
+
+def check_backup(m):
+    # A problem with backup m, or None.
+    path = os.path.join(BACKUP_DIR, m["name"])
+    if not os.path.exists(path):
+        return "file is missing"
+    if os.path.getsize(path) != m["bytes"] or file_sha256(path) != m["sha256"]:
+        return "checksum differs from the manifest"
+    if m["kind"] == "full":
+        with closing(sqlite3.connect(pathlib.Path(path).resolve().as_uri() + "?mode=ro", uri=True)) as db:
+            result = db.execute("PRAGMA quick_check").fetchone()[0]
+        if result != "ok":
+            return f"quick_check: {result}"
+    return None
+
+def apply_change(cur, rec):
+    table, key, cols = next(t for t in CHANGE_LOG_TABLES if t[0] == rec["tbl"])
+    if rec["op"] == "D":
+        cur.execute(f"DELETE FROM {table} WHERE {key}=?", (rec["row_key"],))
+        return
+    row = json.loads(rec["data"]); names = (key, *cols)
+    cur.execute(f"INSERT INTO {table}({', '.join(names)}) VALUES ({', '.join('?'*len(names))}) ON CONFLICT({key}) DO UPDATE SET "
+                + ", ".join(f"{c}=excluded.{c}" for c in cols), [row[n] for n in names])
+
+def restore_backup(out, at=None):
+    # Writes the database as it was at `at` (a utc_stamp(); None for the newest change backed up) to a new
+    # file `out`. Returns (full snapshot used, seq and at of the last change applied).
+    manifests = backup_manifests()
+    fulls = [m for m in manifests if m["kind"] == "full" and (at is None or m["last_at"] <= at)]
+    if not fulls:
+        raise ValueError("No full backup from before that time.")
+    base = fulls[-1]
+    seq, last_at = base["seq"], base["last_at"]
+    tmp = f"{out}.{os.getpid()}.tmp"; conn = None
+    try:
+        if (problem := check_backup(base)):
+            raise ValueError(f"{base['name']}: {problem}")
+        shutil.copyfile(os.path.join(BACKUP_DIR, base["name"]), tmp)
+        conn = sqlite3.connect(tmp); cur = conn.cursor()
+        # Replayed rows go into change_log as they were instead of being logged again.
+        change_log_triggers(cur, create=False)
+        done = False
+        for m in manifests:
+            if done or m["kind"] != "incremental" or m["seq"] <= seq: continue
+            if m["after"] > seq:
+                raise ValueError(f"Incremental backups between changes {seq} and {m['after']} are missing.")
+            if (problem := check_backup(m)):
+                raise ValueError(f"{m['name']}: {problem}")
+            with gzip.open(os.path.join(BACKUP_DIR, m["name"]), "rt", encoding="utf-8") as f:
+                for rec in map(json.loads, f):
+                    if rec["seq"] <= seq: continue
+                    if at and rec["at"] > at:
+                        done = True; break
+                    apply_change(cur, rec)
+                    cur.execute("INSERT INTO change_log(seq, at, tbl, op, row_key, data) VALUES (?, ?, ?, ?, ?, ?)",
+                                (rec["seq"], rec["at"], rec["tbl"], rec["op"], rec["row_key"], rec["data"]))
+                    seq, last_at = rec["seq"], rec["at"]
+        change_log_triggers(cur)
+        rebuild_rollups(cur)
+        # A 'ref' version no running app has used, so no PDF or ETag cached against the live database matches.
+        cur.execute("INSERT INTO data_versions(scope, version) VALUES ('ref', ?) ON CONFLICT(scope) DO UPDATE SET version=excluded.version",
+                    (time.time_ns() // 1000,))
+        conn.commit()
+        if (result := conn.execute("PRAGMA quick_check").fetchone()[0]) != "ok":
+            raise ValueError(f"Restored database failed quick_check: {result}")
+        conn.close(); conn = None
+        os.replace(tmp, out)
+    finally:
+        if conn is not None: conn.close()
+        if os.path.exists(tmp): os.remove(tmp)
+    return base["name"], seq, last_at
+
+def backup_scheduler():
+    while True:
+        time.sleep(BACKUP_EVERY_MIN * 60)
+        try:
+            run_backup("auto", wait=False)
+        except Exception:
+            app.logger.exception("scheduled backup failed")
+
+@app.before_request
+def start_backup_scheduler():
+    # Started by a worker's first request rather than on import, so under --preload it runs in the workers
+    # and not in the master that forks them.
+    global _backup_thread
+    if BACKUP_EVERY_MIN and _backup_thread is None:
+        with _backup_thread_lock:
+            if _backup_thread is None:
+                _backup_thread = threading.Thread(target=backup_scheduler, name="backup", daemon=True)
+                _backup_thread.start()
+
+def run_backup_job(kind):
+    try:
+        run_backup(kind)
+    except Exception:
+        app.logger.exception("%s backup failed", kind)
+
+@app.route("/backup", methods=["POST"])
+def backup_now():
+    kind = request.form.get("kind", "full")
+    if kind not in ("full", "incremental"):
+        return jsonify(error="kind must be full or incremental."), 400
+    if kind == "incremental" and not any(m["kind"] == "full" for m in backup_manifests()):
+        return jsonify(error="No full backup to follow yet."), 409
+    report_pool().submit(run_backup_job, kind)
+    return jsonify(queued=kind), 202
+
+@app.cli.command("backup")
+@click.option("--incremental", is_flag=True, help="Only the changes since the previous backup.")
+@click.option("--verify", is_flag=True, help="Check every backup against its manifest (and full ones with quick_check).")
+def backup_command(incremental, verify):
+    """Back up the database to BACKUP_DIR: a full online snapshot, or --incremental changes."""
+    if verify:
+        problems = 0
+        for m in backup_manifests():
+            problem = check_backup(m)
+            problems += bool(problem)
+            click.echo(f"{m['name']}: {m['kind']} to change {m['seq']} ({m['bytes']:,} bytes, {m['created']})" + (f" - {problem}" if problem else ""))
+        click.echo("backups OK" if not problems else f"{problems} backup problems")
+        if problems: raise SystemExit(1)
+        return
+    try:
+        m = run_backup("incremental" if incremental else "full")
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"{os.path.join(BACKUP_DIR, m['name'])}: to change {m['seq']}, {m['bytes']:,} bytes" if m else "no changes since the last backup")
+
+@app.cli.command("restore-backup")
+@click.argument("out")
+@click.option("--at", help="Point in time, ISO format; UTC unless it carries an offset. Default: the newest change backed up.")
+def restore_backup_command(out, at):
+    """Rebuild the database from BACKUP_DIR into a new file OUT, as of --at."""
+    if os.path.exists(out):
+        raise click.ClickException(f"{out} already exists.")
+    if at:
+        try:
+            t = datetime.fromisoformat(at.replace("Z", "+00:00"))
+        except ValueError:
+            raise click.BadParameter("use an ISO date/time, e.g. 2026-10-18T14:30", param_hint="--at")
+        at = utc_stamp(t.astimezone(timezone.utc) if t.tzinfo else t)
+    try:
+        name, seq, last_at = restore_backup(out, at)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"{out}: {name} + changes to {seq} ({last_at or 'none'}). Stop the app and move it over {DB_PATH} "
+               "(removing its -wal/-shm files), then take a full backup.")
 
 # ---------- Download endpoint for generated PDFs ----------
 @app.route("/download_report")
@@ -530,10 +2848,11 @@ def download_report():
         path = fname
     path = os.path.realpath(path)
     reports_root = os.path.realpath(REPORTS_DIR)
-    if not path.startswith(reports_root) or not os.path.exists(path):
+    # Open without a login (see require_login), so only generated PDFs at the top of REPORTS_DIR.
+    if os.path.dirname(path) != reports_root or not path.endswith(".pdf") or not os.path.exists(path):
         flash("Report not found.", "warning")
         return redirect(url_for("monthly_reports"))
-    return send_file(path, as_attachment=True)
+    return send_file(path, as_attachment=True, download_name=CACHE_SUFFIX.sub(".pdf", os.path.basename(path)))
 
 if __name__ == "__main__":
     app.run(host="127.0.0.1", port=5000, debug=True)
@@ -0,0 +1,170 @@
+"""Benchmark the main routes through the Flask test client.
+
+    python bench.py                                  # 100k entries, scratch DB in the temp dir
+    python bench.py --entries 1000000 --save bench_baseline.json
+    python bench.py --entries 1000000 --compare bench_baseline.json
+
+The scratch database is seeded once per (entries, seed) and reused. Report routes are timed cold
+(PDF cache emptied before every run) unless the case says cached.
+"""
+import argparse, glob, json, math, os, platform, subprocess, sys, tempfile, time
+from datetime import date, datetime, timedelta
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+def peak_rss_mb():
+    if resource is None: return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024*1024 if sys.platform == "darwin" else 1024), 1)
+
+def percentile(times, p):
+    times = sorted(times)
+    return times[max(0, math.ceil(p/100 * len(times)) - 1)]
+
+def clear_reports(dd):
+    for p in glob.glob(os.path.join(dd.REPORTS_DIR, "*.pdf")): os.remove(p)
+
+def newest_report(dd):
+    files = glob.glob(os.path.join(dd.REPORTS_DIR, "*.pdf"))
+    return max(files, key=os.path.getmtime) if files else None
+
+def cases(dd, conn):
+    month = conn.execute("SELECT MAX(month) FROM ledger_rollups WHERE month<?", (datetime.now().strftime("%Y-%m"),)).fetchone()[0]
+    year, mon = (int(x) for x in month.split("-"))
+    truck = conn.execute("SELECT id FROM trucks ORDER BY id LIMIT 1").fetchone()[0]
+    last = dd.month_after(date(year, mon, 1)) - timedelta(days=1)
+    pay = dict(driver_id="all", date_from=f"{month}-01", date_to=str(last))
+    # (name, method, path, form data, is a report, cold)
+    return [
+        ("home", "GET", "/", None, False, False),
+        ("expense_income", "GET", "/expense_income", None, False, False),
+        ("expense_income (truck filter)", "GET", f"/expense_income?truck_id={truck}", None, False, False),
+        ("monthly_reports (truck)", "POST", "/monthly_reports", dict(truck_id=str(truck), month=str(mon), year=str(year)), True, True),
+        ("monthly_reports (all)", "POST", "/monthly_reports", dict(truck_id="all", month=str(mon), year=str(year)), True, True),
+        ("monthly_reports (all, cached)", "POST", "/monthly_reports", dict(truck_id="all", month=str(mon), year=str(year)), True, False),
+        ("driver_pay (month, all drivers)", "POST", "/driver_pay", pay, True, True),
+        ("analytics (json)", "GET", "/api/analytics", None, False, False),
+        ("download_report", "GET", None, None, False, False),
+    ]
+
+def run(dd, runs, report_runs):
+    client = dd.app.test_client()
+    with client.session_transaction() as s: s["logged_in"] = True
+    conn = dd.connect_db(readonly=True)
+    results = {}
+    download = None
+    for name, method, path, data, is_report, cold in cases(dd, conn):
+        if path is None:
+            path = f"/download_report?fname={os.path.basename(download)}"
+        times = []; pdf_size = None
+        for _ in range(report_runs if is_report else runs):
+            if cold: clear_reports(dd)
+            started = time.perf_counter()
+            resp = client.open(path, method=method, data=data)
+            body = resp.get_data()
+            times.append(time.perf_counter() - started)
+            if resp.status_code != 200:
+                raise SystemExit(f"{name}: HTTP {resp.status_code}")
+            if is_report:
+                download = newest_report(dd); pdf_size = os.path.getsize(download) if download else None
+            elif name == "download_report":
+                pdf_size = len(body)
+        results[name] = {"runs": len(times), "p50_ms": round(percentile(times, 50)*1000, 2),
+                         "p95_ms": round(percentile(times, 95)*1000, 2), "peak_rss_mb": peak_rss_mb(), "pdf_bytes": pdf_size}
+        r = results[name]
+        print(f"{name:34} p50 {r['p50_ms']:9.1f} ms  p95 {r['p95_ms']:9.1f} ms  rss {r['peak_rss_mb']} MB"
+              + (f"  pdf {pdf_size:,} B" if pdf_size else ""), flush=True)
+    conn.close()
+    return results
+
+# Run in a fresh interpreter: prints import time, first GET / and first PDF report, in ms.
+STARTUP_PROBE = """
+import sys, time
+started = time.perf_counter()
+import app as dd
+imported = time.perf_counter()
+client = dd.app.test_client()
+with client.session_transaction() as s: s["logged_in"] = True
+client.get("/")
+home = time.perf_counter()
+client.post("/monthly_reports", data=dict(truck_id="all", month=sys.argv[1], year=sys.argv[2]))
+print((imported - started) * 1000, (home - imported) * 1000, (time.perf_counter() - home) * 1000)
+"""
+
+def startup(dd, runs):
+    # Worker cold start: what a fresh gunicorn worker pays before and while serving its first requests.
+    month = dd.connect_db(readonly=True).execute("SELECT MAX(month) FROM ledger_rollups WHERE month<?", (datetime.now().strftime("%Y-%m"),)).fetchone()[0]
+    year, mon = month.split("-")
+    times = [[], [], []]
+    for _ in range(runs):
+        clear_reports(dd)
+        out = subprocess.run([sys.executable, "-c", STARTUP_PROBE, str(int(mon)), year], cwd=os.path.dirname(os.path.abspath(dd.__file__)),
+                             capture_output=True, text=True, check=True).stdout.split()
+        for t, v in zip(times, out): t.append(float(v) / 1000)
+    results = {}
+    for name, t in zip(("startup: import", "startup: first GET /", "startup: first report"), times):
+        results[name] = {"runs": runs, "p50_ms": round(percentile(t, 50)*1000, 2), "p95_ms": round(percentile(t, 95)*1000, 2),
+                         "peak_rss_mb": None, "pdf_bytes": None}
+        print(f"{name:34} p50 {results[name]['p50_ms']:9.1f} ms  p95 {results[name]['p95_ms']:9.1f} ms", flush=True)
+    return results
+
+def compare(results, baseline, tolerance, min_ms):
+    worse = []
+    print(f"\n{'route':34} {'p95 base':>10} {'p95 now':>10} {'change':>8}")
+    for name, r in results.items():
+        b = baseline["routes"].get(name)
+        if not b: continue
+        change = (r["p95_ms"] - b["p95_ms"]) / max(b["p95_ms"], 1e-9) * 100
+        flag = " REGRESSION" if change > tolerance and r["p95_ms"] - b["p95_ms"] > min_ms else ""
+        if flag: worse.append(name)
+        print(f"{name:34} {b['p95_ms']:10.1f} {r['p95_ms']:10.1f} {change:+7.1f}%{flag}")
+    return worse
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--entries", type=int, default=100000)
+    ap.add_argument("--trucks", type=int, default=50)
+    ap.add_argument("--drivers", type=int, default=100)
+    ap.add_argument("--years", type=int, default=5)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--db", help="Scratch database (default: one per entries/seed in the temp dir).")
+    ap.add_argument("--runs", type=int, default=30, help="Runs per page route.")
+    ap.add_argument("--report-runs", type=int, default=5, help="Runs per report route.")
+    ap.add_argument("--startup-runs", type=int, default=5, help="Fresh interpreters started to time import and first requests.")
+    ap.add_argument("--save", metavar="JSON", help="Write the results as a baseline.")
+    ap.add_argument("--compare", metavar="JSON", help="Compare with a saved baseline; exit 1 on a p95 regression.")
+    ap.add_argument("--tolerance", type=float, default=25, help="Allowed p95 slowdown in percent (default 25).")
+    ap.add_argument("--min-ms", type=float, default=2, help="Ignore p95 slowdowns smaller than this (default 2 ms).")
+    args = ap.parse_args()
+
+    scratch = os.path.join(tempfile.gettempdir(), f"dd_bench_{args.entries}_{args.seed}")
+    os.environ["DD_DB_PATH"] = args.db or scratch + ".db"
+    os.environ["DD_REPORTS_DIR"] = scratch + "_reports"
+    fresh = not os.path.exists(os.environ["DD_DB_PATH"])
+    import app as dd
+    if fresh:
+        print(f"seeding {args.entries:,} entries into {dd.DB_PATH} ...", flush=True)
+        conn = dd.connect_db()
+        started = time.perf_counter()
+        dd.seed_database(conn, args.entries, args.trucks, args.drivers, args.years, args.seed)
+        conn.close()
+        print(f"seeded in {time.perf_counter()-started:.1f}s", flush=True)
+
+    results = startup(dd, args.startup_runs)
+    results.update(run(dd, args.runs, args.report_runs))
+    report = {"meta": {"entries": args.entries, "seed": args.seed, "python": platform.python_version(),
+                       "platform": platform.platform(), "when": datetime.now().isoformat(timespec="seconds")},
+              "routes": results}
+    if args.save:
+        with open(args.save, "w") as f: json.dump(report, f, indent=2)
+        print(f"baseline saved to {args.save}")
+    if args.compare:
+        with open(args.compare) as f: baseline = json.load(f)
+        if compare(results, baseline, args.tolerance, args.min_ms):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()